@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measures the overhead of calling an API method: binding the arguments,
+building the request and parsing a tiny response, with a stub transport
+that answers instantly.
+
+    python benchmarks/bench_calls.py [-n NUM_CALLS]
+"""
+
+from optparse import OptionParser
+from datetime import datetime
+
+from common import timeit
+from posterous.api import API
+from posterous.transport import Transport
+
+
+class StubResponse(object):
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def getheader(self, name, default=None):
+        return default
+
+    def read(self, amt=None):
+        return self.payload
+
+    def close(self):
+        pass
+
+
+class StubTransport(Transport):
+    """Answers every request with the same payload"""
+    payload = '<rsp stat="ok"><post><id>1</id><title>A</title></post></rsp>'
+
+    def urlopen(self, method, url, body=None, headers=None):
+        return StubResponse(self.payload)
+
+
+def call_cases():
+    """Returns (name, function) tuples of the calls to measure"""
+    api = API('user', 'pass', transport=StubTransport())
+    date = datetime(2010, 5, 3)
+    return [
+        ('bind read_posts', lambda: API.read_posts.api_method(
+            api, (), {'site_id': 1, 'num_posts': 10, 'page': 2})),
+        ('get_post', lambda: api.get_post('abc')),
+        ('read_posts kwargs', lambda: api.read_posts(site_id=1, page=2, 
+                                                     num_posts=10)),
+        ('new_post', lambda: api.new_post(1, 'Title', 'Body', tags='a,b', 
+                                          date=date, private=True)),
+    ]
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-calls", type="int", dest="num_calls",
+        default=20000, help="Number of calls per case. Default is 20000")
+    (options, args) = opt_parser.parse_args()
+
+    n = options.num_calls
+    for name, call in call_cases():
+        def run():
+            for i in xrange(n):
+                call()
+        best = timeit(run, repeat=3)
+        print '%-18s %6.1f us/call (%.0f calls/s)' % \
+              (name, best / n * 1e6, n / best)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Compares parsing the dates of API responses with strptime (as
+utils.parse_datetime did before) to the hand-rolled parse_datetime, with
+and without its cache, and measures parsing posts with lazy dates.
+
+    python benchmarks/bench_dates.py [-n NUM_DATES]
+"""
+
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from common import posts_xml, Method, timeit
+from posterous import utils
+from posterous.parsers import ModelParser
+
+
+def strptime_datetime(time_string):
+    utc_offset_str = time_string[-6:].strip()
+    sign = 1
+    if utc_offset_str[0] == '-':
+        sign = -1
+        utc_offset_str = utc_offset_str[1:5]
+    utcoffset = sign * timedelta(hours=int(utc_offset_str[0:2]),
+                                 minutes=int(utc_offset_str[2:4]))
+    return datetime.strptime(time_string[:-6],
+                             '%a, %d %b %Y %H:%M:%S') - utcoffset
+
+
+def uncached_datetime(time_string):
+    utils._datetime_cache.clear()
+    return utils.parse_datetime(time_string)
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-dates", type="int", dest="num_dates",
+        default=20000, help="Number of dates to parse. Default is 20000")
+    (options, args) = opt_parser.parse_args()
+
+    start = datetime(2009, 5, 3, 19, 58, 58)
+    unique = [(start + timedelta(minutes=i)).strftime(
+              '%a, %d %b %Y %H:%M:%S -0800') for i in range(options.num_dates)]
+    # most posts of a response share a few timestamps with their comments
+    repeated = [unique[i % 100] for i in range(options.num_dates)]
+
+    print '%d dates' % options.num_dates
+    for name, func in (('strptime', strptime_datetime),
+                       ('hand-rolled', uncached_datetime),
+                       ('hand-rolled, cached', utils.parse_datetime)):
+        for kind, dates in (('unique', unique), ('repeated', repeated)):
+            seconds = timeit(lambda: map(func, dates), repeat=3)
+            print '  %-20s %-8s %.4fs (%.2fus/date)' % \
+                  (name, kind, seconds, seconds / len(dates) * 1e6)
+
+    method = Method()
+    payload = posts_xml(500, num_comments=5)
+    for lazy_types in ((), ('date',)):
+        parser = ModelParser(lazy_types=lazy_types)
+        seconds = timeit(lambda: parser.parse(method, payload), repeat=3)
+        print 'ModelParser(lazy_types=%r), 500 posts: %.4fs' % \
+              (lazy_types, seconds)
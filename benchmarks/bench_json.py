@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Compares parsing readposts responses as XML and as JSON into models, 
+using the JSON decoder picked by posterous.parsers (ujson, simplejson or
+the json module).
+
+    python benchmarks/bench_json.py [-n NUM_POSTS]
+"""
+
+import json
+from optparse import OptionParser
+import xml.etree.cElementTree as ET
+
+from common import posts_xml, Method, timeit
+from posterous.parsers import ModelParser, json_loads
+
+
+def element_json(element):
+    """Returns the JSON counterpart of an XML element"""
+    if not len(element):
+        return (element.text or '').strip()
+    data = {}
+    for child in element:
+        value = element_json(child)
+        if child.tag not in data:
+            data[child.tag] = value
+        elif isinstance(data[child.tag], list):
+            data[child.tag].append(value)
+        else:
+            data[child.tag] = [data[child.tag], value]
+    return data
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=500, help="Number of posts to parse. Default is 500")
+    (options, args) = opt_parser.parse_args()
+
+    print 'JSON decoder: %s.%s' % (json_loads.__module__, json_loads.__name__)
+    parser = ModelParser()
+    for comments, media in ((0, 0), (2, 1), (10, 5)):
+        payload = posts_xml(options.num_posts, comments, media)
+        json_payload = json.dumps([element_json(post) 
+                                   for post in ET.XML(payload)])
+        print '%d posts with %d comments and %d media each ' \
+              '(%d KB XML, %d KB JSON)' % (options.num_posts, comments, media, 
+              len(payload) / 1024, len(json_payload) / 1024)
+
+        xml_time = timeit(lambda: parser.parse(Method(), payload))
+        json_time = timeit(lambda: parser.parse(Method(response_type='json'),
+                                                json_payload))
+        print '  xml  %.4fs  json %.4fs  speedup %.2fx' % \
+              (xml_time, json_time, xml_time / json_time)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Compares building an index page (id and title of every post) from a 
+readposts response with the eager DirectModelParser and LazyModelParser,
+and the time to access all attributes of the lazy models afterwards.
+
+    python benchmarks/bench_lazy.py [-n NUM_POSTS]
+"""
+
+from optparse import OptionParser
+
+from common import posts_xml, Method, timeit
+from posterous.parsers import DirectModelParser, LazyModelParser
+
+
+def index_page(parser, method, payload):
+    return [(post.id, post.title) for post in parser.parse(method, payload)]
+
+
+def read_all(parser, method, payload):
+    for post in parser.parse(method, payload):
+        post.id, post.title, post.body, post.date
+        for media in getattr(post, 'media', []):
+            media.url
+        for comment in getattr(post, 'comments', []):
+            comment.body
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=500, help="Number of posts to parse. Default is 500")
+    (options, args) = opt_parser.parse_args()
+
+    method = Method()
+    for comments, media in ((0, 0), (2, 1), (10, 5)):
+        payload = posts_xml(options.num_posts, comments, media)
+        print '%d posts with %d comments and %d media each (%d KB)' % \
+              (options.num_posts, comments, media, len(payload) / 1024)
+
+        for name, func in (('index page', index_page), 
+                           ('all attributes', read_all)):
+            eager = timeit(lambda: func(DirectModelParser(), method, payload))
+            lazy = timeit(lambda: func(LazyModelParser(), method, payload))
+            print '  %-15s eager %.4fs  lazy %.4fs  speedup %.2fx' % \
+                  (name, eager, lazy, eager / lazy)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Compares the memory used by the regular and the compact models for a
+parsed readposts response.
+
+    python benchmarks/bench_models.py [-n NUM_POSTS]
+"""
+
+from optparse import OptionParser
+import sys
+
+from common import posts_xml, Method, timeit
+from posterous.models import Model, CompactModel, ModelFactory, \
+                             CompactModelFactory
+from posterous.parsers import ModelParser
+
+
+def model_size(obj):
+    """Bytes used by the model objects, their dicts and nested models"""
+    if isinstance(obj, list):
+        return sys.getsizeof(obj) + sum(model_size(o) for o in obj)
+    if not isinstance(obj, Model):
+        return 0
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, CompactModel):
+        values = [getattr(obj, name) for name in obj.__slots__
+                  if hasattr(obj, name)]
+        if obj._extra:
+            size += sys.getsizeof(obj._extra)
+            values.extend(obj._extra.values())
+    else:
+        size += sys.getsizeof(obj.__dict__)
+        values = obj.__dict__.values()
+    return size + sum(model_size(v) for v in values)
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=1000, help="Number of posts to parse. Default is 1000")
+    (options, args) = opt_parser.parse_args()
+
+    payload = posts_xml(options.num_posts)
+    method = Method()
+
+    print 'Parsing %d posts (2 comments, 1 medium each)' % options.num_posts
+    results = {}
+    for name, factory in (('regular', ModelFactory),
+                          ('compact', CompactModelFactory)):
+        parser = ModelParser(factory)
+        posts = parser.parse(method, payload)
+        seconds = timeit(lambda: parser.parse(method, payload), repeat=3)
+        results[name] = model_size(posts)
+        print '%-8s %10d bytes (%6d per post) parsed in %.3fs' % \
+              (name, results[name], results[name] / options.num_posts, seconds)
+
+    print 'compact models use %.0f%% less memory' % \
+          (100 - 100.0 * results['compact'] / results['regular'])
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Compares the parse time of ModelParser (XML -> XMLDict -> models) and 
+DirectModelParser (XML -> models) for readposts responses.
+
+    python benchmarks/bench_parsers.py [-n NUM_POSTS] [-f id,title,date,link]
+"""
+
+from optparse import OptionParser
+
+from common import posts_xml, Method, timeit
+from posterous.bind import _fields
+from posterous.parsers import ModelParser, DirectModelParser
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=500, help="Number of posts to parse. Default is 500")
+    opt_parser.add_option("-f", "--fields", dest="fields", default=None,
+        help="Only parse these comma separated fields of the posts")
+    (options, args) = opt_parser.parse_args()
+
+    method = Method(fields=_fields(options.fields))
+    for comments, media in ((0, 0), (2, 1), (10, 5)):
+        payload = posts_xml(options.num_posts, comments, media)
+        print '%d posts with %d comments and %d media each (%d KB)' % \
+              (options.num_posts, comments, media, len(payload) / 1024)
+
+        times = {}
+        for parser in (ModelParser(), DirectModelParser()):
+            name = parser.__class__.__name__
+            times[name] = timeit(lambda: parser.parse(method, payload))
+            print '  %-18s %.4fs (%.0f posts/s)' % \
+                  (name, times[name], options.num_posts / times[name])
+        print '  speedup %.2fx' % \
+              (times['ModelParser'] / times['DirectModelParser'])
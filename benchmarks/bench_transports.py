@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Measures the end to end throughput of reading posts from a local
+MockServer with each transport: urllib2 (a new connection per request),
+the keep-alive ConnectionPool, and replaying recorded responses, which
+leaves out the network.
+
+    python benchmarks/bench_transports.py [-n NUM_POSTS] [-p PER_PAGE] 
+                                          [-l LATENCY]
+"""
+
+import os
+import tempfile
+from optparse import OptionParser
+
+from common import timeit
+from posterous.api import API
+from posterous.mockserver import MockServer
+from posterous.pool import ConnectionPool
+from posterous.transport import UrllibTransport, RecordingTransport, \
+                                ReplayTransport
+
+
+def read_all(api, num_posts, per_page):
+    pages = -(-num_posts // per_page)
+    for page in xrange(1, pages + 1):
+        api.read_posts(site_id=1, num_posts=per_page, page=page)
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=1000, help="Number of posts read. Default is 1000")
+    opt_parser.add_option("-p", "--per-page", type="int", dest="per_page",
+        default=20, help="Number of posts per page. Default is 20")
+    opt_parser.add_option("-l", "--latency", type="float", dest="latency",
+        default=0, help="Seconds the server delays every response by. "
+                        "Default is 0")
+    (options, args) = opt_parser.parse_args()
+
+    server = MockServer(num_posts=options.num_posts, 
+                        latency=options.latency).start()
+    fd, recording = tempfile.mkstemp(suffix='.rec')
+    os.close(fd)
+    try:
+        # the responses to replay
+        api = API('user', 'pass', host=server.url,
+                  transport=RecordingTransport(ConnectionPool(), recording))
+        read_all(api, options.num_posts, options.per_page)
+
+        transports = [
+            ('urllib2', UrllibTransport()),
+            ('connection pool', ConnectionPool()),
+            ('replay', ReplayTransport(recording)),
+        ]
+        for name, transport in transports:
+            api = API('user', 'pass', host=server.url, transport=transport)
+            best = timeit(lambda: read_all(api, options.num_posts, 
+                                           options.per_page), repeat=3)
+            print '%-16s %7.3fs %8.0f posts/s' % \
+                  (name, best, options.num_posts / best)
+            transport.clear()
+    finally:
+        server.stop()
+        os.remove(recording)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compares casting the leaf elements of a readposts response with the
+compiled 'casters' dict (parsers.set_type) against scanning every key of
+models.attribute_map, as set_type did before.
+
+    python benchmarks/bench_types.py [-n NUM_POSTS]
+"""
+
+from optparse import OptionParser
+import xml.etree.cElementTree as ET
+
+from common import posts_xml, Method, timeit
+from posterous.models import attribute_map
+from posterous.parsers import set_type, ModelParser
+
+
+def scanning_set_type(name, value):
+    for names in attribute_map:
+        if name in names:
+            return attribute_map.get(names)(value)
+    return value
+
+
+def cast_all(leaves, set_type):
+    for tag, text in leaves:
+        set_type(tag, text)
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-n", "--num-posts", type="int", dest="num_posts",
+        default=1000, help="Number of posts to parse. Default is 1000")
+    (options, args) = opt_parser.parse_args()
+
+    payload = posts_xml(options.num_posts, num_comments=5, num_media=2)
+    leaves = [(e.tag.lower(), (e.text or '').strip())
+              for e in ET.XML(payload).iter() if not len(e)]
+    # dates are cast the same way by both, leave them out to compare lookups
+    no_dates = [(tag, text) for tag, text in leaves if tag != 'date']
+
+    print '%d leaf elements (%d without dates)' % (len(leaves), len(no_dates))
+    for name, func in (('scanning', scanning_set_type),
+                       ('compiled', set_type)):
+        all_leaves = timeit(lambda: cast_all(leaves, func))
+        lookups = timeit(lambda: cast_all(no_dates, func))
+        print '  %-9s all leaves %.4fs, without dates %.4fs (%.2fus/leaf)' % \
+              (name, all_leaves, lookups, lookups / len(no_dates) * 1e6)
+
+    method = Method()
+    seconds = timeit(lambda: ModelParser().parse(method, payload), repeat=3)
+    print 'ModelParser, %d posts: %.4fs' % (options.num_posts, seconds)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measures how the XML -> XMLDict conversion scales with the number of
+sibling elements (wide responses) and with the nesting depth (deep
+responses). For linear scaling, the time per element stays flat and
+doubling the size doubles the time.
+
+    python benchmarks/bench_xmldict.py [-s SIZES]
+"""
+
+from optparse import OptionParser
+import xml.etree.cElementTree as ET
+
+from common import timeit
+from posterous.parsers import XMLDict
+
+
+def wide_repeated(n):
+    """A post with n siblings sharing the same tag"""
+    return '<post>%s</post>' % ''.join('<tag>tag %d</tag>' % i
+                                       for i in xrange(n))
+
+
+def wide_distinct(n):
+    """A post with n siblings with different tags"""
+    return '<post>%s</post>' % ''.join('<field%d>%d</field%d>' % (i, i, i)
+                                       for i in xrange(n))
+
+
+def wide_nested(n):
+    """A post with n media elements, each holding a medium and a thumb"""
+    media = '<media><type>image</type><medium><url>u</url><width>1</width>' \
+            '</medium><thumb><url>t</url><width>2</width></thumb></media>'
+    return '<post>%s</post>' % (media * n)
+
+
+def deep(n):
+    """n / 20 levels of nesting, each with a few leaf siblings"""
+    # the conversion is recursive, so stay well below the recursion limit
+    xml = '<leaf>x</leaf>'
+    for i in xrange(n / 20):
+        xml = '<level><id>%d</id><name>level</name>%s</level>' % (i, xml)
+    return '<post>%s</post>' % xml
+
+
+SHAPES = (('wide, repeated tags', wide_repeated),
+          ('wide, distinct tags', wide_distinct),
+          ('wide, nested media', wide_nested),
+          ('deep', deep))
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-s", "--sizes", dest="sizes",
+        default="250,500,1000,2000,4000", help="Comma separated list of " \
+            "sizes. Default is 250,500,1000,2000,4000")
+    (options, args) = opt_parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+
+    for name, shape in SHAPES:
+        print name
+        previous = None
+        for size in sizes:
+            element = ET.XML(shape(size))
+            count = len(list(element.iter()))
+            number = max(1, 20000 / count)
+            seconds = timeit(lambda: XMLDict(element), number=number)
+            growth = previous and '%.2fx' % (seconds / previous) or '-'
+            print '  %6d elements %9.5fs %8.2fus/element  growth %s' % \
+                  (count, seconds, seconds / count * 1e6, growth)
+            previous = seconds
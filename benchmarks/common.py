@@ -0,0 +1,47 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+Helpers shared by the benchmark scripts: synthetic API responses and
+timing.
+"""
+
+import os
+import sys
+import time
+
+# make the posterous package importable when run from a checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from posterous.mockserver import posts_xml, sites_xml
+
+
+class Method(object):
+    """Stands in for a bound API method when calling parsers directly."""
+    def __init__(self, payload_type='post', payload_list=True,
+                 response_type='xml', fields=None):
+        self.payload_type = payload_type
+        self.payload_list = payload_list
+        self.response_type = response_type
+        self.fields = fields
+        self.api = None
+
+
+def timeit(func, repeat=5, number=1):
+    """Returns the best time in seconds of 'repeat' runs of func."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
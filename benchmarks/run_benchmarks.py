@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Runs the benchmark suite and stores the results as JSON, so they can be
+compared across versions:
+
+  parse   - posts/s of XMLParser, ModelParser and DirectModelParser for
+            responses of varying post, comment and media counts
+  calls   - the overhead of calling bound API methods, with a stub transport
+  dates   - parse_datetime, for unique and repeated dates
+  memory  - bytes per post of the regular and the compact models
+  backup  - posts/s of scripts/backup-posterous.py against a MockServer
+
+    python benchmarks/run_benchmarks.py [-o results.json] [--quick]
+                                        [-s parse,calls] [-c old.json]
+
+With -c, every result is compared with the one of the same name in an
+earlier results file, and those which got worse by more than the
+threshold (-t, in percent) are listed; the exit status is then 1.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from common import posts_xml, Method, timeit
+from bench_calls import call_cases
+from bench_models import model_size
+import posterous
+from posterous import utils
+from posterous.mockserver import MockServer
+from posterous.models import ModelFactory, CompactModelFactory
+from posterous.parsers import XMLParser, ModelParser, DirectModelParser
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BACKUP_SCRIPT = os.path.join(ROOT, 'scripts', 'backup-posterous.py')
+
+
+def result(name, value, unit, higher_is_better=True):
+    return {'name': name, 'value': value, 'unit': unit,
+            'higher_is_better': higher_is_better}
+
+
+def bench_parse(quick):
+    sizes = quick and [10, 100] or [10, 100, 1000]
+    shapes = [(0, 0), (2, 1), (10, 3)]
+    parsers = [('XMLParser', XMLParser()), ('ModelParser', ModelParser()),
+               ('DirectModelParser', DirectModelParser())]
+    method = Method()
+    results = []
+    for num_posts in sizes:
+        for num_comments, num_media in shapes:
+            payload = posts_xml(num_posts, num_comments, num_media)
+            for name, parser in parsers:
+                # small responses are parsed often enough to be measurable
+                seconds = timeit(lambda: parser.parse(method, payload),
+                                 repeat=quick and 2 or 5,
+                                 number=max(1, 1000 // num_posts))
+                results.append(result(
+                    'parse/%s/posts=%d,comments=%d,media=%d' %
+                    (name, num_posts, num_comments, num_media),
+                    num_posts / seconds, 'posts/s'))
+    return results
+
+
+def bench_calls(quick):
+    n = quick and 2000 or 20000
+    results = []
+    for name, call in call_cases():
+        def run():
+            for i in xrange(n):
+                call()
+        seconds = timeit(run, repeat=3)
+        results.append(result('calls/%s' % name, seconds / n * 1e6,
+                              'us/call', False))
+    return results
+
+
+def bench_dates(quick):
+    n = quick and 2000 or 20000
+    start = datetime(2009, 5, 3, 19, 58, 58)
+    unique = [(start + timedelta(minutes=i)).strftime(
+              '%a, %d %b %Y %H:%M:%S -0800') for i in range(n)]
+    repeated = [unique[i % 100] for i in range(n)]
+
+    def parse_unique():
+        for date in unique:
+            utils._datetime_cache.clear()
+            utils.parse_datetime(date)
+
+    results = [result('dates/unique', timeit(parse_unique, repeat=3) / n
+                      * 1e6, 'us/date', False)]
+    seconds = timeit(lambda: map(utils.parse_datetime, repeated), repeat=3)
+    results.append(result('dates/repeated', seconds / n * 1e6, 'us/date',
+                          False))
+    return results
+
+
+def bench_memory(quick):
+    num_posts = quick and 100 or 1000
+    payload = posts_xml(num_posts)
+    results = []
+    for name, factory in (('regular', ModelFactory),
+                          ('compact', CompactModelFactory)):
+        posts = ModelParser(factory).parse(Method(), payload)
+        results.append(result('memory/%s' % name,
+                              model_size(posts) / float(num_posts),
+                              'bytes/post', False))
+    return results
+
+
+def bench_backup(quick):
+    num_posts = quick and 100 or 500
+    server = MockServer(num_sites=2, num_posts=num_posts).start()
+    folder = tempfile.mkdtemp()
+    # the script imports the package of this checkout
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + 
+        filter(None, [env.get('PYTHONPATH')]))
+    try:
+        started = time.time()
+        subprocess.check_call([sys.executable, BACKUP_SCRIPT, '-u', 'user',
+                               '-p', 'pass', '--host', server.url,
+                               '-f', folder, '--full'],
+                              stdout=open(os.devnull, 'w'), env=env)
+        seconds = time.time() - started
+    finally:
+        server.stop()
+        shutil.rmtree(folder, True)
+    return [result('backup/posts', 2 * num_posts / seconds, 'posts/s')]
+
+
+BENCHMARKS = [('parse', bench_parse), ('calls', bench_calls),
+              ('dates', bench_dates), ('memory', bench_memory),
+              ('backup', bench_backup)]
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'),
+                                cwd=ROOT
+                                ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, old_results, threshold):
+    """Prints the changes to the old results; returns the regressions."""
+    old = dict((r['name'], r) for r in old_results)
+    regressions = []
+    for r in results:
+        if r['name'] not in old or not old[r['name']]['value']:
+            continue
+        # positive changes are improvements
+        if r['higher_is_better']:
+            change = (r['value'] / old[r['name']]['value'] - 1) * 100
+        else:
+            change = (old[r['name']]['value'] / r['value'] - 1) * 100
+        print '%-55s %+7.1f%%' % (r['name'], change)
+        if change < -threshold:
+            regressions.append(r['name'])
+    return regressions
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-o", "--output", dest="output",
+        default="benchmark-results.json", help="File to store the results "
+        "in. Default is benchmark-results.json")
+    opt_parser.add_option("-s", "--select", dest="select",
+        help="Comma-separated benchmarks to run (%s). Default is all" %
+             ','.join(name for name, func in BENCHMARKS))
+    opt_parser.add_option("-q", "--quick", dest="quick", action="store_true",
+        default=False, help="Use smaller inputs and fewer repetitions")
+    opt_parser.add_option("-c", "--compare", dest="compare",
+        help="Results of an earlier run to compare with")
+    opt_parser.add_option("-t", "--threshold", type="float",
+        dest="threshold", default=10, help="Percentage by which a result "
+        "may get worse before it counts as a regression. Default is 10")
+    (options, args) = opt_parser.parse_args()
+
+    selected = options.select and options.select.split(',') or \
+               [name for name, func in BENCHMARKS]
+    results = []
+    for name, func in BENCHMARKS:
+        if name not in selected:
+            continue
+        for r in func(options.quick):
+            print '%-55s %12.2f %s' % (r['name'], r['value'], r['unit'])
+            results.append(r)
+
+    with open(options.output, 'w') as f:
+        json.dump({'version': posterous.__version__,
+                   'revision': git_revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   'quick': options.quick,
+                   'results': results}, f, indent=2)
+    print 'Results stored in %s' % options.output
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        print '\nCompared with %s (%s):' % (options.compare,
+                                            old.get('revision'))
+        regressions = compare(results, old['results'], options.threshold)
+        if regressions:
+            print '\n%d regressions:\n  %s' % (len(regressions),
+                                              '\n  '.join(regressions))
+            sys.exit(1)
@@ -17,7 +17,8 @@ __author__ = "Benjamin Reitzammer <http://github.com/nureineide>"
 __email__ = "benjamin@squeakyvessel.com"
 __credits__ = ['Michael Campagnaro <http://github.com/mikecampo>']
 
-from posterous.api import API
+from posterous.api import API, AsyncAPI
+from posterous.cursor import Cursor
 
 # unauthenticated instance 
 api = API()
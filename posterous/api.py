@@ -7,21 +7,147 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
+import os
+from base64 import b64encode
 from datetime import datetime
 
 from posterous.parsers import ModelParser
+from posterous.pool import ConnectionPool
+from posterous.cursor import Cursor
+from posterous.cache import MemoryCache
+from posterous.executor import Executor
+from posterous.download import Downloader, file_name
+from posterous.ratelimit import TokenBucket
 from posterous.bind import bind_method
+from posterous.multipart import File
 from posterous.utils import *
 
 
+def _connection_setting(name):
+    """
+    A property whose changes rebuild the base url and the auth header,
+    which are then reused by every call.
+    """
+    attr = '_' + name
+
+    def get(self):
+        return getattr(self, attr, None)
+
+    def set(self, value):
+        setattr(self, attr, value)
+        self.api_url = (self.host or '') + (self.api_root or '')
+        self.auth_header = None
+        if self.username and self.password:
+            self.auth_header = 'Basic %s' % b64encode(
+                '%s:%s' % (self.username, self.password))
+    return property(get, set)
+
+
 class API(object):
+    username = _connection_setting('username')
+    password = _connection_setting('password')
+    host = _connection_setting('host')
+    api_root = _connection_setting('api_root')
+
     def __init__(self, username=None, password=None, 
-                 host='https://posterous.com', api_root='/api', parser=None):
+                 host='https://posterous.com', api_root='/api', parser=None,
+                 max_connections=4, idle_timeout=60, timeout=None,
+                 cache=None, cache_timeouts=None, conditional_requests=False,
+                 rate_limit=None, max_retries=3, transport=None, 
+                 metrics=None):
         self.username = username
         self.password = password
         self.host = host
         self.api_root = api_root
         self.parser = parser or ModelParser()
+        # sends the requests of all API methods; by default over pooled
+        # keep-alive connections (see posterous.transport for others)
+        self.transport = transport or \
+                         ConnectionPool(max_connections, idle_timeout, timeout)
+        # caches the results of read methods; 'cache_timeouts' maps a 
+        # method path (e.g. 'readposts') to its own timeout in seconds
+        self.cache = cache
+        self.cache_timeouts = cache_timeouts or {}
+        # keeps the ETag/Last-Modified validators of read method responses 
+        # together with their results, for revalidating them later
+        self.validators = None
+        if conditional_requests:
+            self.validators = MemoryCache(timeout=0)
+        # limits the requests; a number of requests per second or a 
+        # TokenBucket, which may be shared with other instances (or with 
+        # other processes, see FileTokenBucket)
+        if isinstance(rate_limit, (int, long, float)):
+            rate_limit = TokenBucket(rate_limit)
+        self.limiter = rate_limit
+        # how often a request is sent again while the server throttles it
+        self.max_retries = max_retries
+        # receives the timings, sizes and errors of the requests (see 
+        # posterous.metrics); None measures nothing
+        self.metrics = metrics
+        # saves media files; set its 'segments' to download large files
+        # with parallel ranged requests
+        self.downloader = Downloader(self.transport, 
+                                     max_workers=max_connections)
+
+    def iter_posts(self, prefetch=False, **kwargs):
+        """
+        Iterates over all posts, requesting the pages from 'read_posts' 
+        on demand. Accepts the same arguments as 'read_posts'. If 
+        'prefetch' is True, the next page is requested in the background.
+        """
+        return Cursor(self.read_posts, **kwargs).items(prefetch=prefetch)
+
+    def get_posts_batch(self, ids, max_workers=None):
+        """
+        Fetches the posts for many Post.ly shortcodes concurrently, making
+        at most 'max_workers' requests at a time (defaults to the number of
+        connections of the transport). Repeated ids are only requested once.
+
+        Returns a list of (id, post, error) tuples in the order of 'ids'.
+        For ids which couldn't be fetched, post is None and error holds 
+        the exception; the other ids are not affected.
+        """
+        ids = list(ids)
+        executor = Executor(max_workers or self.transport.maxsize)
+        futures = {}
+        try:
+            for id in ids:
+                if id not in futures:
+                    # the blocking method, even when called on an AsyncAPI
+                    futures[id] = executor.submit(API.get_post, self, id)
+
+            results = []
+            for id in ids:
+                error = futures[id].exception()
+                if error is None:
+                    results.append((id, futures[id].result(), None))
+                else:
+                    results.append((id, None, error))
+            return results
+        finally:
+            executor.shutdown(wait=False)
+
+    def download_media(self, posts, folder, max_workers=None):
+        """
+        Saves the media of all posts into 'folder', downloading at most 
+        'max_workers' files at a time. The files are named after the post
+        id and the file name in the url.
+
+        Returns a list of (media, path, error) tuples, error being None 
+        for the files which were saved.
+        """
+        files = []
+        media = []
+        for post in posts:
+            for m in getattr(post, 'media', []):
+                url = m.url
+                path = os.path.join(folder, '%s-%s' % (post.id, file_name(url)))
+                files.append((url, path))
+                media.append(m)
+
+        results = self.downloader.download_all(files, max_workers=max_workers)
+        return [(m, path, error) for m, (url, path), (u, r, error) 
+                in zip(media, files, results)]
 
     ## API methods 
     """
@@ -37,12 +163,21 @@ class API(object):
         'payload_list'  - If True, a list of 'payload_type' objects is returned.
         'response_type' - Determines which parser to use. Set to 'json' if the
                           response is in JSON format. Defaults to 'xml' if not
-                          specified.
+                          specified. Callers may pass response_type='json' to
+                          ask for JSON, which is faster to decode; XML 
+                          answers are still parsed.
         'allowed_param' - A list of params that the API method accepts. Must be
                           formatted as a list of tuples, with the param name
                           being paired with the expected value type. If more
                           than one type is allowed, place the types in a tuple.
         'require_auth'  - True if the API method requires authentication.
+        'cacheable'     - True if the results may be stored in the API's
+                          cache.
+        'invalidates'   - A list of paths of other API methods whose cached
+                          results are removed after a successful request.
+        'files'         - The params whose values are files. Requests with
+                          files are sent as a streamed multipart/form-data
+                          body.
     """
     
     ## Reading 
@@ -55,7 +190,8 @@ class API(object):
         payload_type = 'site',
         payload_list = True,
         allowed_param = [],
-        require_auth = True
+        require_auth = True,
+        cacheable = True
     )
 
     """
@@ -73,7 +209,8 @@ class API(object):
             ('num_posts', int), 
             ('page', int),
             ('tag', basestring)],
-        require_auth = False
+        require_auth = False,
+        cacheable = True
     )
 
     """
@@ -86,7 +223,8 @@ class API(object):
         path = 'getpost',
         payload_type = 'post',
         allowed_param = [('id', basestring)],
-        require_auth = False
+        require_auth = False,
+        cacheable = True
     )
         
     """
@@ -102,14 +240,18 @@ class API(object):
         allowed_param = [
             ('site_id', int),
             ('hostname', basestring)],
-        require_auth = False
+        require_auth = False,
+        cacheable = True
     )
 
     ## Posting
     """
     Creates a new post and returns a post object.
-    The media param must be set to file data. If posting 
-    multiple files, provide a list of file data.
+    The media param may be set to file data, a File (the name of
+    a file, see posterous.multipart) or an open file-like object.
+    If posting multiple files, provide a list of them.
+    Files are streamed; pass progress=func(sent, total) to follow 
+    the upload.
     """
     new_post = bind_method(
         path = 'newpost',
@@ -119,20 +261,25 @@ class API(object):
             ('site_id', int), 
             ('title', basestring),
             ('body', basestring), 
-            ('media', (basestring, list)), 
+            ('media', (basestring, File, list)), 
             ('autopost', bool), 
             ('private', bool), 
             ('date', datetime), 
             ('tags', basestring), 
             ('source', basestring), 
             ('sourceLink', basestring)],
-        require_auth = True
+        require_auth = True,
+        files = ['media'],
+        invalidates = ['getsites', 'readposts', 'gettags']
     )
 
     """
     Returns an updated post.
-    The media param must be set to file data. If posting 
-    multiple files, provide a list of file data.
+    The media param may be set to file data, a File (the name of
+    a file, see posterous.multipart) or an open file-like object.
+    If posting multiple files, provide a list of them.
+    Files are streamed; pass progress=func(sent, total) to follow 
+    the upload.
     """
     update_post = bind_method(
         path = 'updatepost',
@@ -142,8 +289,10 @@ class API(object):
             ('post_id', int),
             ('title', basestring),
             ('body', basestring), 
-            ('media', (basestring, list))],
-        require_auth = True
+            ('media', (basestring, File, list))],
+        require_auth = True,
+        files = ['media'],
+        invalidates = ['readposts', 'getpost', 'gettags']
     )
    
     """
@@ -163,7 +312,8 @@ class API(object):
             ('name', basestring),
             ('email', basestring),
             ('date', datetime)],
-        require_auth = True
+        require_auth = True,
+        invalidates = ['readposts', 'getpost']
     )
 
     ## Twitter
@@ -174,8 +324,9 @@ class API(object):
     post to their default site. If not registered, Posterous
     will create a new site for them.
 
-    The media param must be set to file data. If posting
-    multiple files, provide a list of file data.
+    The media param may be set to file data, a File (the name of
+    a file, see posterous.multipart) or an open file-like object.
+    If posting multiple files, provide a list of them.
         
     Returns a JSON object with the post id and post url.
     """
@@ -184,14 +335,15 @@ class API(object):
         method = 'POST',
         payload_type = 'json',
         response_type = 'json',
-        allowed_params = [
+        allowed_param = [
             ('username', basestring), 
             ('password', basestring), 
-            ('media', (basestring, list)),
+            ('media', (basestring, File, list)),
             ('message', basestring),
             ('body', basestring),
             ('source', basestring),
-            ('sourceLink', basestring)]
+            ('sourceLink', basestring)],
+        files = ['media']
     )
         
     """
@@ -203,13 +355,49 @@ class API(object):
         method = 'POST',
         payload_type = 'json',
         response_type = 'json',
-        allowed_params = [
+        allowed_param = [
             ('username', basestring), 
             ('password', basestring), 
-            ('media', (basestring, list)),
+            ('media', (basestring, File, list)),
             ('message', basestring),
             ('body', basestring),
             ('source', basestring),
-            ('sourceLink', basestring)]
+            ('sourceLink', basestring)],
+        files = ['media']
     )
-        
+
+
+class AsyncAPI(API):
+    """
+    Offers the same methods as API, but every call returns a Future 
+    straight away while the request is made by one of 'concurrency' 
+    worker threads. All workers share the API's transport.
+
+    Example:
+        futures = [api.read_posts(site_id=id) for id in site_ids]
+        posts = [f.result() for f in futures]
+    """
+    def __init__(self, *args, **kwargs):
+        concurrency = kwargs.pop('concurrency', 8)
+        kwargs.setdefault('max_connections', concurrency)
+        API.__init__(self, *args, **kwargs)
+        self.executor = Executor(concurrency)
+
+    def iter_posts(self, prefetch=False, **kwargs):
+        read_posts = lambda *args, **kw: self.read_posts(*args, **kw).result()
+        return Cursor(read_posts, **kwargs).items(prefetch=prefetch)
+
+    def close(self):
+        """Stops the worker threads and closes the idle connections."""
+        self.executor.shutdown()
+        self.transport.clear()
+
+
+def _submit(call):
+    def _call(api, *args, **kwargs):
+        return api.executor.submit(call, api, *args, **kwargs)
+    return _call
+
+for name, value in API.__dict__.items():
+    if hasattr(value, 'api_method'):
+        setattr(AsyncAPI, name, _submit(value))
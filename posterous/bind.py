@@ -7,15 +7,28 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
+import httplib
+import random
+import socket
+import time
 import urllib
-import urllib2
 from datetime import datetime
-from base64 import b64encode
 
+from posterous.error import PosterousError, TransportError, HTTPError, \
+                            RateLimitError
+from posterous.models import Model
+from posterous.multipart import MultipartBody
 from posterous.utils import enc_utf8_str
 
 
 def bind_method(**options):
+    # lookup tables built once per method, instead of on every call
+    param_types = [(name, isinstance(p_type, tuple) and p_type or (p_type,))
+                   for name, p_type in options.get('allowed_param', [])]
+    param_index = dict((name, i) for i, (name, p_type) 
+                       in enumerate(param_types))
+    files = options.get('files', [])
+    file_names = frozenset(files) | frozenset('%s[]' % name for name in files)
 
     class APIMethod(object):
         # Get the options for the api method
@@ -26,52 +39,85 @@ def bind_method(**options):
         allowed_param = options.get('allowed_param', [])
         method = options.get('method', 'GET')
         require_auth = options.get('require_auth', False)
+        cacheable = options.get('cacheable', False)
+        invalidates = options.get('invalidates', [])
+        # the options a call may pass, besides the params
+        stream = False
+        fields = None
+        progress = None
+        # the seconds the phases of the request took, if the API has metrics
+        timings = None
 
         def __init__(self, api, args, kwargs):
             # If the method requires authentication and no credentials
             # are provided, throw an error
-            if self.require_auth and not (api.username and api.password):
-                raise Exception('Authentication is required!')
+            if self.require_auth and not api.auth_header:
+                raise PosterousError('Authentication is required!')
 
             self.api = api
-            self.headers = kwargs.pop('headers', {})
-            self.api_url = api.host + api.api_root
+            self.headers = {}
+            if api.metrics is not None:
+                self.timings = {}
+            if kwargs:
+                self._pop_options(kwargs)
+            if self.response_type == 'json':
+                self.headers.setdefault('Accept', 'application/json')
             self._build_parameters(args, kwargs)
 
+        def _pop_options(self, kwargs):
+            if 'headers' in kwargs:
+                self.headers.update(kwargs.pop('headers'))
+            if 'stream' in kwargs:
+                # list methods can yield their models while the response 
+                # is still being received
+                self.stream = kwargs.pop('stream') and self.payload_list
+            if 'fields' in kwargs:
+                # only these tags of the payload models are parsed
+                self.fields = _fields(kwargs.pop('fields'))
+            if 'progress' in kwargs:
+                # called with the bytes sent and the total of an upload
+                self.progress = kwargs.pop('progress')
+            if 'response_type' in kwargs:
+                # JSON may be requested instead of XML, as it decodes faster
+                self.response_type = kwargs.pop('response_type')
+
         def _build_parameters(self, args, kwargs):
             self.parameters = []
-            
-            args = list(args)
-            args.reverse()
-
-            for name, p_type in self.allowed_param:
-                value = None
-                if args:
-                    value = args.pop()
-
-                if name in kwargs:
-                    if not value:
-                        value = kwargs.pop(name)
-                    else:
-                        raise TypeError('Multiple values for parameter %s supplied!' % name)
-                if not value:
-                    continue
 
-                if not isinstance(p_type, tuple):
-                    p_type = (p_type,)
+            # (index, value) of the params which were given
+            values = [(i, value) for i, value 
+                      in enumerate(args[:len(param_types)]) if value]
+            for name, value in kwargs.iteritems():
+                i = param_index.get(name)
+                if i is None:
+                    continue
+                if i < len(args) and args[i]:
+                    raise TypeError('Multiple values for parameter %s supplied!' % name)
+                if value:
+                    values.append((i, value))
+            if len(values) > 1:
+                values.sort()
 
+            for i, value in values:
+                name, p_type = param_types[i]
                 self._check_type(value, p_type, name)
                 self._set_param(name, value)
             
         def _check_type(self, value, p_type, name):
             """
             Throws a TypeError exception if the value type is not in the p_type tuple.
+            Params sent as files also take any object with a read() method.
             """
+            is_file = name in file_names
+            if is_file and hasattr(value, 'read'):
+                return
             if not isinstance(value, p_type):
                 raise TypeError('The value passed for parameter %s is not valid! It must be one of these: %s' % (name, p_type))
 
             if isinstance(value, list):
                 for val in value:
+                    if is_file and hasattr(val, 'read'):
+                        continue
                     if isinstance(val, list) or not isinstance(val, p_type):
                         raise TypeError('A value passed for parameter %s is not valid. It must be one of these: %s' % (name, p_type))
             
@@ -85,41 +131,282 @@ def bind_method(**options):
             
             elif isinstance(value, list):
                 for val in value:
-                    self.parameters.append(('%s[]' % name, enc_utf8_str(val)))
+                    if name not in file_names:
+                        val = enc_utf8_str(val)
+                    self.parameters.append(('%s[]' % name, val))
                 return
 
-            self.parameters.append((name, enc_utf8_str(value)))
+            if name not in file_names:
+                # files are sent as they are, see MultipartBody
+                value = enc_utf8_str(value)
+            self.parameters.append((name, value))
 
         def execute(self):
+            # Return the cached result if there is one
+            cache = self.api.cache
+            if cache and self.cacheable and not self.stream:
+                cache_key = self._cache_key()
+                result = cache.get(cache_key)
+                if result is not None:
+                    _attach_api(result, self.api)
+                    return result
+
+            try:
+                result = self._request()
+            except Exception, e:
+                if self.timings is not None:
+                    self.api.metrics.error(self.path, e)
+                raise
+
+            if cache and self.cacheable and not self.stream:
+                cache.store(cache_key, result, 
+                            self.api.cache_timeouts.get(self.path))
+            if cache and self.invalidates:
+                # drop the cached results this request has made stale
+                for path in self.invalidates:
+                    cache.invalidate(path + '?')
+            return result
+
+        def _cache_key(self):
+            """The path and parameters of the request, the user and fields"""
+            key = '%s?%s#%s' % (self.path, urllib.urlencode(self.parameters),
+                                enc_utf8_str(self.api.username or ''))
+            if self.fields is not None:
+                key += '#' + ','.join(sorted(self.fields))
+            return key
+
+        def _request(self):
             # Build request URL
-            url = self.api_url + '/' + self.path
+            url = self.api.api_url + '/' + self.path
 
             # Apply authentication if required
-            if self.api.username and self.api.password:
-                auth = b64encode('%s:%s' % (self.api.username, self.api.password))
-                self.headers['Authorization'] = 'Basic %s' % auth
+            if self.api.auth_header:
+                self.headers['Authorization'] = self.api.auth_header
            
             # Encode the parameters
             post_data = None
-            if self.method == 'POST':
+            if self.method == 'POST' and self._has_files():
+                # streams the files instead of encoding them in memory
+                post_data = MultipartBody(self.parameters, file_names,
+                                          self.progress)
+                self.headers['Content-Type'] = post_data.content_type
+                self.headers['Content-Length'] = str(len(post_data))
+            elif self.method == 'POST':
                 post_data = urllib.urlencode(self.parameters)
             elif self.method == 'GET' and self.parameters:
                 url = '%s?%s' % (url, urllib.urlencode(self.parameters))
             
-            # Make the request
+            # Revalidate the result of an earlier request if the server 
+            # sent validators for it
+            validators = self.api.validators
+            validated = None
+            if validators is not None and self.cacheable and not self.stream:
+                validator_key = self._cache_key()
+                validated = validators.get(validator_key)
+                if validated:
+                    etag, last_modified, result = validated
+                    if etag:
+                        self.headers['If-None-Match'] = etag
+                    if last_modified:
+                        self.headers['If-Modified-Since'] = last_modified
+
+            # Make the request with the API's transport
+            if post_data is not None:
+                self.headers.setdefault('Content-Type', 
+                                        'application/x-www-form-urlencoded')
+            timings = self.timings
             try:
-                request = urllib2.Request(url, post_data, self.headers)
-                resp = urllib2.urlopen(request)
+                resp = self._send(url, post_data)
+                if self.stream and 200 <= resp.status < 300:
+                    return StreamedModels(resp, self._stream(resp))
+                if timings is not None:
+                    started = time.time()
+                payload = resp.read()
+                if timings is not None:
+                    timings['download'] = time.time() - started
+            except PosterousError:
+                raise
             except Exception, e:
-                # TODO: do better parsing of errors
-                raise Exception('Failed to send request: %s' % e)
+                raise TransportError('Failed to send request: %s' % e)
+            finally:
+                if isinstance(post_data, MultipartBody):
+                    post_data.close()
+
+            if resp.status == 304 and validated:
+                # not modified, so the parsed result is still valid
+                _attach_api(result, self.api)
+                if timings is not None:
+                    self._report(post_data, payload)
+                return result
+
+            if not 200 <= resp.status < 300:
+                raise HTTPError('Failed to send request: HTTP Error %s: %s' % 
+                                (resp.status, resp.reason), resp.status)
+
+            if timings is None:
+                result = self.api.parser.parse(self, payload)
+            else:
+                started = time.time()
+                result = self.api.parser.parse(self, payload)
+                elapsed = time.time() - started
+                # parsers record the time they took to decode the payload
+                timings['build'] = elapsed - timings.setdefault('parse', 
+                                                                elapsed)
+                self._report(post_data, payload)
+
+            if validators is not None and self.cacheable and not self.stream:
+                etag = resp.getheader('ETag')
+                last_modified = resp.getheader('Last-Modified')
+                if etag or last_modified:
+                    validators.store(validator_key, 
+                                     (etag, last_modified, result))
+            return result
+
+        def _send(self, url, post_data):
+            """
+            Makes the request within the API's rate limit. While the server
+            throttles it, it's sent again after the delay the server asks 
+            for, or an exponential back-off, up to 'max_retries' times.
+            """
+            api = self.api
+            retries = 0
+            while True:
+                if api.limiter:
+                    api.limiter.acquire()
+                if self.timings is None:
+                    resp = api.transport.urlopen(self.method, url, post_data, 
+                                                 self.headers)
+                else:
+                    started = time.time()
+                    resp = api.transport.urlopen(self.method, url, post_data, 
+                                                 self.headers)
+                    # transports which open connections may report the 
+                    # time that took
+                    connect = getattr(resp, 'connect_time', 0)
+                    self.timings['connect'] = connect
+                    self.timings['ttfb'] = time.time() - started - connect
+                if resp.status not in (429, 503):
+                    if api.limiter:
+                        api.limiter.succeeded()
+                    return resp
 
-            return self.api.parser.parse(self, resp.read())
+                resp.read()
+                delay = _retry_after(resp, retries)
+                if retries >= api.max_retries:
+                    raise RateLimitError('Failed to send request: HTTP Error '
+                                         '%s: %s' % (resp.status, resp.reason),
+                                         resp.status, delay)
+                if api.limiter:
+                    api.limiter.throttled(delay)
+                else:
+                    time.sleep(delay)
+                retries += 1
+                if hasattr(post_data, 'seek'):
+                    post_data.seek(0)
+
+        def _has_files(self):
+            for name, value in self.parameters:
+                if name in file_names:
+                    return True
+            return False
+
+        def _stream(self, resp):
+            timings = self.timings
+            if timings is not None:
+                started = time.time()
+            try:
+                try:
+                    for result in self.api.parser.parse_stream(self, resp):
+                        yield result
+                except (httplib.HTTPException, socket.error), e:
+                    # the connection failed while the body was read
+                    raise TransportError('Failed to read response: %s' % e)
+            except Exception, e:
+                if timings is not None:
+                    self.api.metrics.error(self.path, e)
+                raise
+            finally:
+                # hands the connection back if the caller stopped early
+                resp.close()
+            if timings is not None:
+                timings['download'] = time.time() - started
+                self._report(None, '')
+
+        def _report(self, post_data, payload):
+            sent = post_data is not None and len(post_data) or 0
+            self.api.metrics.request(self.path, self.timings, sent, 
+                                     len(payload))
 
     
     def _call(api, *args, **kwargs):
         method = APIMethod(api, args, kwargs)
         return method.execute()
 
+    # lets API variants like AsyncAPI find and wrap the bound methods
+    _call.api_method = APIMethod
     return _call
 
+
+class StreamedModels(object):
+    """
+    Iterates over the models of a streamed response. Its connection goes
+    back to the pool once all models have been read or the iterator is 
+    closed, which happens when it's discarded too, even if it was never
+    started.
+    """
+    def __init__(self, resp, models):
+        self._resp = resp
+        self._models = models
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._models.next()
+
+    def close(self):
+        self._models.close()
+        # a generator that never started doesn't run its finally clause
+        self._resp.close()
+
+    def __del__(self):
+        self.close()
+
+
+# the longest a throttled request waits before it's sent again
+MAX_BACKOFF = 60
+
+
+def _retry_after(resp, retries):
+    """The seconds to wait before sending a throttled request again"""
+    try:
+        return min(MAX_BACKOFF, max(0, int(resp.getheader('Retry-After'))))
+    except (TypeError, ValueError):
+        # exponential back-off, with jitter so that clients don't retry 
+        # all at once
+        return min(MAX_BACKOFF, 2 ** retries * (1 + random.random() / 2))
+
+
+def _fields(fields):
+    """
+    Returns the set of tag names for a list of fields or a comma separated
+    string of them.
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    fields = set(f.strip().lower() for f in fields)
+    if 'comments' in fields:
+        # each comment has its own tag, see XMLParser.cleanup
+        fields.add('comment')
+    return frozenset(fields)
+
+
+def _attach_api(result, api):
+    """Sets the api on models which were loaded from a cache"""
+    if isinstance(result, list):
+        for obj in result:
+            _attach_api(obj, api)
+    elif isinstance(result, Model):
+        result._api = api
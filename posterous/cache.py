@@ -0,0 +1,230 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import cPickle as pickle
+import hashlib
+import os
+import threading
+import time
+import urllib
+
+
+class Cache(object):
+    """
+    Cache interface. Values are stored for 'timeout' seconds unless a
+    different timeout is passed to store(). A timeout of 0 means the
+    value never expires.
+    """
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def store(self, key, value, timeout=None):
+        """Adds a new value to the cache"""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns the value for the key, or None if missing or expired"""
+        raise NotImplementedError
+
+    def invalidate(self, prefix):
+        """Removes all values whose key starts with the prefix"""
+        raise NotImplementedError
+
+    def count(self):
+        """Returns the number of values in the cache"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Removes all values from the cache"""
+        raise NotImplementedError
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        if not timeout:
+            return None
+        return time.time() + timeout
+
+
+class MemoryCache(Cache):
+    """
+    In-memory cache. Once it holds 'maxsize' values, the least recently
+    used one is evicted.
+    """
+    def __init__(self, timeout=60, maxsize=1000):
+        Cache.__init__(self, timeout)
+        self.maxsize = maxsize
+        # maps the keys to the links [prev, next, key, value, expires] of
+        # a circular list, which runs from the least to the most recently
+        # used value (collections.OrderedDict needs python 2.7)
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+
+    def store(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            link = self._entries.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            self._entries[key] = self._append([None, None, key, value, 
+                                               self._expires(timeout)])
+            while len(self._entries) > self.maxsize:
+                oldest = self._unlink(self._root[1])
+                del self._entries[oldest[2]]
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            link = self._entries.get(key)
+            if link is None:
+                return None
+            expires = link[4]
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                self._unlink(link)
+                return None
+            # move it to the end as the most recently used value
+            self._append(self._unlink(link))
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def invalidate(self, prefix):
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                if key.startswith(prefix):
+                    self._unlink(self._entries.pop(key))
+        finally:
+            self._lock.release()
+
+    def count(self):
+        return len(self._entries)
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+        return link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+        return link
+
+
+class FileCache(Cache):
+    """
+    Pickles every value to its own file inside 'cache_dir'. The cache
+    can be shared by several processes.
+
+    A file is named after the method path of its key (the part before
+    '?') and the key's hash, and starts with the key and expiry time, so
+    invalidate() doesn't have to load the values.
+    """
+    def __init__(self, cache_dir, timeout=60):
+        Cache.__init__(self, timeout)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+
+    def store(self, key, value, timeout=None):
+        path = self._path(key)
+        # write to a temporary file first, so readers never see half a value
+        tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump((key, self._expires(timeout)), f,
+                        pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def get(self, key):
+        entry = self._load(self._path(key))
+        if entry is None:
+            return None
+        stored_key, expires, value = entry
+        if expires is not None and expires <= time.time():
+            self._remove(self._path(key))
+            return None
+        return value
+
+    def invalidate(self, prefix):
+        method_path, query, rest = prefix.partition('?')
+        for name in self._names():
+            name_path = urllib.unquote(name.rpartition('-')[0])
+            path = os.path.join(self.cache_dir, name)
+            if not query:
+                # the prefix ends within the method path
+                if name_path.startswith(prefix):
+                    self._remove(path)
+            elif name_path == method_path:
+                if not rest:
+                    self._remove(path)
+                    continue
+                entry = self._load(path, header_only=True)
+                if entry is not None and entry[0].startswith(prefix):
+                    self._remove(path)
+
+    def count(self):
+        return len(self._names())
+
+    def flush(self):
+        for name in self._names():
+            self._remove(os.path.join(self.cache_dir, name))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s-%s.cache' % 
+                            (urllib.quote(key.partition('?')[0], safe=''),
+                             hashlib.md5(key).hexdigest()))
+
+    def _names(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.cache')]
+
+    def _load(self, path, header_only=False):
+        """
+        Returns a tuple of the key, expiry time and value stored in the
+        file, or only of the key and expiry time if 'header_only' is set.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                key, expires = pickle.load(f)
+                if header_only:
+                    return key, expires
+                return key, expires, pickle.load(f)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                return None
+        finally:
+            f.close()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
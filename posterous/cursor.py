@@ -0,0 +1,97 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import threading
+
+
+class Cursor(object):
+    """
+    Pages through the results of a paginated API method (e.g.
+    API.read_posts), requesting each page only when it is needed.
+    Iteration stops at the first page that holds fewer results than
+    were requested.
+
+    Example:
+        for post in Cursor(api.read_posts, site_id=1).items():
+            print post.title
+    """
+    # the maximum number of results the API returns per page
+    page_size = 50
+
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.num_results = kwargs.pop('num_posts', self.page_size)
+        self.start_page = kwargs.pop('page', 1)
+        self.kwargs = kwargs
+
+    def pages(self, limit=0, prefetch=False):
+        """
+        Returns an iterator over the pages, each one being a list of results.
+        If 'prefetch' is True, the next page is requested in the background
+        while the current one is being processed.
+        """
+        page = self.start_page
+        pending = None
+        count = 0
+
+        while not limit or count < limit:
+            if pending:
+                results = pending.result()
+            else:
+                results = self._fetch(page)
+
+            full_page = len(results) >= self.num_results
+            count += 1
+            if prefetch and full_page and (not limit or count < limit):
+                pending = _Prefetch(self._fetch, page + 1)
+            else:
+                pending = None
+
+            if results:
+                yield results
+            if not full_page:
+                break
+            page += 1
+
+    def items(self, limit=0, prefetch=False):
+        """Returns an iterator over the results of all pages."""
+        count = 0
+        for results in self.pages(prefetch=prefetch):
+            for result in results:
+                if limit and count >= limit:
+                    return
+                count += 1
+                yield result
+
+    def _fetch(self, page):
+        return self.method(page=page, num_posts=self.num_results,
+                           *self.args, **self.kwargs)
+
+
+class _Prefetch(object):
+    """Calls the function in a background thread and keeps its result."""
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception, e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
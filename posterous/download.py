@@ -0,0 +1,252 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import hashlib
+import httplib
+import os
+import posixpath
+import socket
+import urllib
+import urlparse
+
+from posterous.pool import ConnectionPool
+from posterous.executor import Executor
+from posterous.error import PosterousError, TransportError, HTTPError
+
+
+# the number of redirects followed for a file
+MAX_REDIRECTS = 5
+
+
+class Downloader(object):
+    """
+    Saves files to disk with a transport, by default a ConnectionPool.
+
+    'chunk_size'   - The number of bytes read and written at a time, so
+                     files are never held in memory completely.
+    'segments'     - The number of ranged requests made in parallel for a
+                     file of at least 'segment_size' bytes, if the server
+                     accepts ranges. Helps with large videos.
+    'max_workers'  - The number of files download_all saves at a time.
+    """
+    def __init__(self, pool=None, chunk_size=64 * 1024, segments=1,
+                 segment_size=8 * 1024 * 1024, max_workers=4):
+        self.pool = pool or ConnectionPool()
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.segment_size = segment_size
+        self.max_workers = max_workers
+
+    def download(self, url, path, checksum=None, hash_name='md5'):
+        """
+        Saves the file at 'url' to 'path' and returns a tuple of its size
+        and hex digest. The data is written to 'path.part' first; a part
+        left by an interrupted download is resumed with a Range request.
+        If 'checksum' doesn't match the digest, the file is removed and
+        a PosterousError is raised.
+        """
+        part = path + '.part'
+        size = None
+        if self.segments > 1 and not os.path.exists(part):
+            size, url = self._ranged_size(url)
+
+        if size is not None and size >= self.segment_size:
+            self._fetch_segments(url, part, size)
+            digest = hashlib.new(hash_name)
+            _hash_file(part, digest)
+        else:
+            size, digest = self._fetch(url, part, hashlib.new(hash_name))
+
+        digest = digest.hexdigest()
+        if checksum and checksum.lower() != digest:
+            os.remove(part)
+            raise PosterousError('Checksum mismatch for %s: expected %s, ' \
+                                 'got %s' % (url, checksum, digest))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(part, path)
+        return size, digest
+
+    def download_all(self, files, checksums=None, max_workers=None):
+        """
+        Saves many files at once, at most 'max_workers' at a time. 'files'
+        is a list of (url, path) tuples and 'checksums' may map a url to
+        its expected digest.
+
+        Returns a list of (url, result, error) tuples in the order of
+        'files', where result is the (size, digest) tuple of download().
+        A failed download doesn't affect the others.
+        """
+        checksums = checksums or {}
+        executor = Executor(max_workers or self.max_workers)
+        try:
+            futures = [(url, executor.submit(self.download, url, path,
+                                             checksums.get(url)))
+                       for url, path in files]
+            results = []
+            for url, future in futures:
+                error = future.exception()
+                if error is None:
+                    results.append((url, future.result(), None))
+                else:
+                    results.append((url, None, error))
+            return results
+        finally:
+            executor.shutdown(wait=False)
+
+    def _fetch(self, url, part, digest):
+        headers = {}
+        offset = 0
+        if os.path.exists(part):
+            offset = _hash_file(part, digest)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+
+        resp = self._open(url, headers)
+        try:
+            if resp.status == 416:
+                # the part already holds the complete file
+                return offset, digest
+            if resp.status == 206:
+                f = open(part, 'ab')
+            else:
+                # the server sent the whole file
+                offset = 0
+                digest = hashlib.new(digest.name)
+                f = open(part, 'wb')
+            try:
+                while True:
+                    chunk = resp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+            finally:
+                f.close()
+        except (httplib.HTTPException, socket.error), e:
+            raise TransportError('Failed to download %s: %s' % (url, e))
+        finally:
+            resp.close()
+        return offset, digest
+
+    def _fetch_segments(self, url, part, size):
+        f = open(part, 'wb')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+        step = -(-size // self.segments)
+        executor = Executor(self.segments)
+        try:
+            futures = [executor.submit(self._fetch_range, url, part, start,
+                                       min(start + step, size) - 1)
+                       for start in range(0, size, step)]
+            for future in futures:
+                future.result()
+        except:
+            # a part with gaps can't be resumed
+            os.remove(part)
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+    def _fetch_range(self, url, path, start, end):
+        resp = self._open(url, {'Range': 'bytes=%d-%d' % (start, end)})
+        try:
+            if resp.status != 206:
+                raise PosterousError('Range request for %s was ignored' % url)
+            f = open(path, 'r+b')
+            try:
+                f.seek(start)
+                received = 0
+                while True:
+                    chunk = resp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+            finally:
+                f.close()
+        except (httplib.HTTPException, socket.error), e:
+            raise TransportError('Failed to download %s: %s' % (url, e))
+        finally:
+            resp.close()
+
+        if received != end - start + 1:
+            raise PosterousError('Incomplete range of %s: got %d of %d ' \
+                                 'bytes' % (url, received, end - start + 1))
+
+    def _ranged_size(self, url):
+        """
+        Returns the size of the file, or None if the server doesn't accept
+        ranges for it, and its url after redirects.
+        """
+        try:
+            resp = self._open(url, method='HEAD')
+        except HTTPError:
+            # some servers don't answer HEAD requests; a single GET will do
+            return None, url
+        resp.read()
+        length = resp.getheader('Content-Length')
+        if resp.status == 200 and length and \
+           resp.getheader('Accept-Ranges', '').lower() == 'bytes':
+            return int(length), resp.url
+        return None, resp.url
+
+    def _open(self, url, headers=None, method='GET'):
+        """
+        Makes the request, following redirects. The url of the file is
+        kept as the response's 'url'.
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            try:
+                resp = self.pool.urlopen(method, url, None, headers)
+            except (httplib.HTTPException, socket.error), e:
+                raise TransportError('Failed to download %s: %s' % (url, e))
+            location = resp.getheader('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            # read the body, so the connection can be reused
+            resp.read()
+            resp.close()
+            url = urlparse.urljoin(url, location)
+        else:
+            raise HTTPError('Failed to download %s: too many redirects' % url,
+                            resp.status)
+
+        if resp.status not in (200, 206, 416):
+            resp.close()
+            raise HTTPError('Failed to download %s: HTTP Error %s: %s' %
+                            (url, resp.status, resp.reason), resp.status)
+        resp.url = url
+        return resp
+
+
+def file_name(url):
+    """Returns the file name at the end of the url's path."""
+    path = urlparse.urlsplit(url).path
+    return urllib.unquote(posixpath.basename(path)) or 'index'
+
+
+def _hash_file(path, digest, chunk_size=64 * 1024):
+    """Updates the hash with the contents of the file; returns its size."""
+    size = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        f.close()
+    return size
@@ -16,3 +16,21 @@ class PosterousError(Exception):
     def __str__(self):
         return '(%s) %s' % (self.error_code, self.message)
 
+
+
+class TransportError(PosterousError):
+    """The request couldn't be sent or its response couldn't be read"""
+
+
+class HTTPError(PosterousError):
+    """The server answered with an error status, kept as the error code"""
+
+
+class RateLimitError(HTTPError):
+    """
+    The server kept throttling the requests (HTTP 429 or 503) after all
+    retries. 'retry_after' is the number of seconds it asked to wait.
+    """
+    def __init__(self, error, code=None, retry_after=None):
+        HTTPError.__init__(self, error, code)
+        self.retry_after = retry_after
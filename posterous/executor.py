@@ -0,0 +1,135 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import Queue
+import sys
+import threading
+
+from posterous.error import PosterousError
+
+
+class Future(object):
+    """The pending result of a call submitted to an Executor."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the call to finish and returns its result. Exceptions
+        raised by the call are raised again.
+        """
+        self._done.wait(timeout)
+        # wait() only returns whether the event is set from python 2.7 on
+        if not self._done.is_set():
+            raise PosterousError('Timed out waiting for the result')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Waits for the call and returns its exception, if it raised one."""
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise PosterousError('Timed out waiting for the result')
+        return self._exc_info and self._exc_info[1]
+
+    def add_done_callback(self, func):
+        """Calls func with the future once it is done."""
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def _set(self, result=None, exc_info=None):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            func(self)
+
+
+class Executor(object):
+    """
+    Runs submitted calls in at most 'max_workers' threads. The threads are
+    started on demand and keep running until shutdown() is called.
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs) and returns its Future."""
+        future = Future()
+        self._lock.acquire()
+        try:
+            if self._idle <= 0 and len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+            else:
+                self._idle -= 1
+        finally:
+            self._lock.release()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def map(self, func, iterable):
+        """Calls func for every item and returns the results in order."""
+        futures = [self.submit(func, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """Stops the threads once the queued calls have been made."""
+        self._lock.acquire()
+        try:
+            threads, self._threads = self._threads, []
+            self._idle = 0
+        finally:
+            self._lock.release()
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+            self._lock.acquire()
+            self._idle += 1
+            self._lock.release()
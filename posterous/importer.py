@@ -0,0 +1,179 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+
+from posterous.download import file_name
+from posterous.error import PosterousError
+from posterous.executor import Executor
+from posterous.multipart import File
+from posterous.ratelimit import TokenBucket
+from posterous.utils import enc_utf8_str, parse_datetime
+
+
+class PostImporter(object):
+    """
+    Creates many posts with API.new_post, for migrating a blog.
+
+    'max_workers' - The number of posts uploaded at a time.
+    'rate'        - The maximum number of posts created per second.
+                    None means no limit.
+    'checkpoint'  - A file recording the imported posts. Posts found in
+                    it are skipped, so running an interrupted import again
+                    resumes it.
+
+    Example:
+        importer = PostImporter(api, rate=2, checkpoint='import.log')
+        for key, post, error in importer.run(posts):
+            ...
+    """
+    def __init__(self, api, max_workers=4, rate=None, checkpoint=None):
+        self.api = api
+        self.max_workers = max_workers
+        self.rate = rate
+        self.checkpoint = checkpoint
+        self._lock = threading.Lock()
+
+    def run(self, posts, callback=None):
+        """
+        Imports the posts, each being a dict of new_post arguments. A post
+        is identified by its 'key' item, or else by its position. 'media'
+        may hold file names or urls, which are downloaded first, and
+        'date' a datetime or its string. 'callback' is called with the
+        key, new post and error of every post once it's done.
+
+        Returns a list of (key, post, error) tuples in the order of 'posts'.
+        Posts that were imported before have a post of None and no error;
+        a failed post, or one that isn't a dict, doesn't stop the others.
+        """
+        done = self._load_checkpoint()
+        # spaces the posts evenly, without bursts
+        throttle = self.rate and TokenBucket(self.rate, capacity=1)
+        # don't read further ahead in 'posts' than the workers can handle
+        slots = threading.Semaphore(self.max_workers * 2)
+        executor = Executor(self.max_workers)
+        futures = []
+        try:
+            for i, post in enumerate(posts):
+                if not isinstance(post, dict):
+                    key = enc_utf8_str(i)
+                    error = PosterousError('Post %s is not a dict: %r' % 
+                                           (key, post))
+                    if callback:
+                        callback(key, None, error)
+                    futures.append((key, error))
+                    continue
+                post = dict(post)
+                key = enc_utf8_str(post.pop('key', i))
+                if key in done:
+                    futures.append((key, None))
+                    continue
+                slots.acquire()
+                future = executor.submit(self._work, key, post, throttle, 
+                                         callback)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append((key, future))
+
+            results = []
+            for key, future in futures:
+                if future is None:
+                    results.append((key, None, None))
+                elif isinstance(future, Exception):
+                    results.append((key, None, future))
+                elif future.exception() is None:
+                    results.append((key, future.result(), None))
+                else:
+                    results.append((key, None, future.exception()))
+            return results
+        finally:
+            # lets the uploads in progress finish and be checkpointed
+            executor.shutdown()
+
+    def _work(self, key, post, throttle, callback):
+        try:
+            result = self._import(key, post, throttle)
+        except Exception, e:
+            if callback:
+                callback(key, None, e)
+            raise
+        if callback:
+            callback(key, result, None)
+        return result
+
+    def _import(self, key, post, throttle):
+        temp_dir = None
+        try:
+            media = post.get('media')
+            if media:
+                # the caller's list is left alone
+                media = isinstance(media, list) and list(media) or [media]
+                for i, ref in enumerate(media):
+                    if not isinstance(ref, basestring):
+                        continue
+                    if ref.split(':', 1)[0] in ('http', 'https'):
+                        temp_dir = temp_dir or tempfile.mkdtemp()
+                        path = os.path.join(temp_dir,
+                                            '%d-%s' % (i, file_name(ref)))
+                        self.api.downloader.download(ref, path)
+                        media[i] = File(path)
+                    else:
+                        # strings would be sent as file data
+                        media[i] = File(ref)
+                post['media'] = media
+            if isinstance(post.get('date'), basestring):
+                post['date'] = _parse_date(post['date'])
+
+            if throttle:
+                throttle.acquire()
+            result = self.api.new_post(**post)
+            self._save_checkpoint(key, result)
+            return result
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, True)
+
+    def _load_checkpoint(self):
+        done = set()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            f = open(self.checkpoint)
+            try:
+                for line in f:
+                    if line.strip():
+                        done.add(line.split('\t')[0])
+            finally:
+                f.close()
+        return done
+
+    def _save_checkpoint(self, key, post):
+        if not self.checkpoint:
+            return
+        self._lock.acquire()
+        try:
+            f = open(self.checkpoint, 'a')
+            try:
+                f.write('%s\t%s\t%s\n' % (key, getattr(post, 'id', ''),
+                                          getattr(post, 'url', '')))
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+
+def _parse_date(value):
+    """Parses a date in the API's format or as ISO 8601 (in UTC)."""
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return datetime(*[int(v) for v in 
+                          re.split('[-T: ]', value.strip()[:19])])
@@ -0,0 +1,176 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import socket
+import threading
+
+# the phases of a request, in seconds:
+#   connect  - opening a new connection (0 if a pooled one was reused)
+#   ttfb     - sending the request until the response headers arrived
+#   download - reading the response body
+#   parse    - decoding the XML or JSON
+#   build    - creating the models
+PHASES = ('connect', 'ttfb', 'download', 'parse', 'build')
+
+
+class Metrics(object):
+    """
+    Receives the measurements of the requests an API makes. Passed to API
+    as 'metrics'; without it, nothing is measured.
+
+    Streamed responses are parsed while they're received, so their
+    'download' time includes parsing and building and they have no
+    'parse' or 'build' time; their received bytes aren't counted. Cached
+    results don't make requests and aren't reported.
+    """
+    def request(self, method, timings, sent, received):
+        """
+        Called after a request of the API method (its path, e.g.
+        'readposts') succeeded, with a dict of the seconds its phases
+        took and the bytes of the request and response bodies.
+        """
+        pass
+
+    def error(self, method, error):
+        """Called with the exception an API method raised."""
+        pass
+
+
+class MetricsCollector(Metrics):
+    """
+    Adds the measurements up per API method, thread-safely.
+
+    Example:
+        metrics = MetricsCollector()
+        api = API('user', 'pass', metrics=metrics)
+        ...
+        print metrics.prometheus()
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def request(self, method, timings, sent, received):
+        self._lock.acquire()
+        try:
+            stats = self._stats(method)
+            stats['requests'] += 1
+            stats['sent'] += sent
+            stats['received'] += received
+            seconds = stats['seconds']
+            for phase, value in timings.iteritems():
+                seconds[phase] = seconds.get(phase, 0) + value
+        finally:
+            self._lock.release()
+
+    def error(self, method, error):
+        self._lock.acquire()
+        try:
+            errors = self._stats(method)['errors']
+            name = type(error).__name__
+            errors[name] = errors.get(name, 0) + 1
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns a dict mapping every API method to a dict of its number
+        of 'requests', bytes 'sent' and 'received', total 'seconds' per
+        phase and 'errors' per exception type.
+        """
+        self._lock.acquire()
+        try:
+            return dict((method, dict(stats, seconds=dict(stats['seconds']),
+                                      errors=dict(stats['errors'])))
+                        for method, stats in self._methods.iteritems())
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._methods = {}
+        finally:
+            self._lock.release()
+
+    def prometheus(self, prefix='posterous'):
+        """Returns the totals in the Prometheus text exposition format."""
+        stats = sorted(self.snapshot().items())
+        lines = []
+
+        def counter(name, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for labels, value in samples:
+                lines.append('%s_%s{%s} %s' % (prefix, name, ','.join(
+                    '%s="%s"' % (label, _escape(v)) for label, v in labels),
+                    value))
+
+        counter('requests_total', 'API requests that succeeded.',
+                [((('method', m),), s['requests']) for m, s in stats])
+        counter('request_seconds_total', 'Seconds spent per request phase.',
+                [((('method', m), ('phase', phase)), s['seconds'][phase])
+                 for m, s in stats for phase in PHASES
+                 if phase in s['seconds']])
+        counter('sent_bytes_total', 'Bytes of request bodies sent.',
+                [((('method', m),), s['sent']) for m, s in stats])
+        counter('received_bytes_total', 'Bytes of response bodies received.',
+                [((('method', m),), s['received']) for m, s in stats])
+        counter('errors_total', 'API method calls that raised an error.',
+                [((('method', m), ('error', name)), count)
+                 for m, s in stats 
+                 for name, count in sorted(s['errors'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def _stats(self, method):
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = {'requests': 0, 'sent': 0,
+                                             'received': 0, 'seconds': {},
+                                             'errors': {}}
+        return stats
+
+
+class StatsdMetrics(Metrics):
+    """
+    Sends the measurements of every request to a StatsD server over UDP:
+    timers in milliseconds for the phases and counters for the requests,
+    bytes and errors, named '<prefix>.<method>.<metric>'. Packets that
+    can't be sent are dropped.
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='posterous'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def request(self, method, timings, sent, received):
+        name = '%s.%s' % (self.prefix, method)
+        lines = ['%s.requests:1|c' % name]
+        for phase, value in timings.iteritems():
+            lines.append('%s.%s:%.3f|ms' % (name, phase, value * 1000))
+        if sent:
+            lines.append('%s.bytes_sent:%d|c' % (name, sent))
+        if received:
+            lines.append('%s.bytes_received:%d|c' % (name, received))
+        self._send('\n'.join(lines))
+
+    def error(self, method, error):
+        self._send('%s.%s.errors.%s:1|c' % (self.prefix, method,
+                                            type(error).__name__))
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
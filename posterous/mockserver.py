@@ -0,0 +1,278 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+"""
+A local stand-in for the Posterous API, serving generated getsites and
+readposts responses, so the library can be measured end to end without
+network access.
+
+    python -m posterous.mockserver [-p PORT] [-n NUM_POSTS] [-l LATENCY]
+
+Example:
+    server = MockServer(num_posts=500, latency=0.05).start()
+    api = API('user', 'pass', host=server.url)
+    ...
+    server.stop()
+"""
+
+import threading
+import time
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+
+
+SITE = """
+    <site>
+        <id>%(id)s</id>
+        <name>Site number %(id)s</name>
+        <url>http://site%(id)s.posterous.com</url>
+        <hostname>site%(id)s</hostname>
+        <private>false</private>
+        <primary>%(primary)s</primary>
+        <commentsenabled>true</commentsenabled>
+        <num_posts>%(num_posts)s</num_posts>
+    </site>"""
+
+POST = """
+    <post>
+        <url>http://post.ly/%(id)s</url>
+        <link>http://sachin.posterous.com/post-%(id)s</link>
+        <title>Post number %(id)s</title>
+        <id>%(id)s</id>
+        <body><![CDATA[<p>%(body)s</p>]]></body>
+        <date>Sun, 03 May 2009 19:58:58 -0800</date>
+        <views>%(id)s</views>
+        <private>false</private>
+        <author>sachin agarwal</author>
+        <authorpic>http://posterous.com/user_profile_pics/16071/pic.png</authorpic>
+        <commentsenabled>true</commentsenabled>
+        <commentscount>%(num_comments)s</commentscount>%(media)s%(comments)s
+    </post>"""
+
+MEDIA = """
+        <media>
+            <type>image</type>
+            <medium>
+                <url>%(host)s/getfile/files/%(id)s/IMG_%(i)s.jpg</url>
+                <filesize>47</filesize>
+                <height>333</height>
+                <width>500</width>
+            </medium>
+            <thumb>
+                <url>%(host)s/getfile/files/%(id)s/IMG_%(i)s.thumb.jpg</url>
+                <filesize>5</filesize>
+                <height>36</height>
+                <width>36</width>
+            </thumb>
+        </media>"""
+
+COMMENT = """
+        <comment>
+            <body>Comment %(i)s on post %(id)s</body>
+            <date>Thu, 04 Jun 2009 01:33:%(sec)02d -0800</date>
+            <author>commenter %(i)s</author>
+            <authorpic>http://posterous.com/user_profile_pics/1/pic.png</authorpic>
+        </comment>"""
+
+ERROR = '<rsp stat="fail"><err code="%s" msg="%s" /></rsp>'
+
+
+def post_xml(id, num_comments=2, num_media=1, body_size=200,
+             host='http://posterous.com'):
+    """Returns the <post> element of a post, with media files on 'host'."""
+    media = ''.join(MEDIA % {'id': id, 'i': i, 'host': host}
+                    for i in range(num_media))
+    comments = ''.join(COMMENT % {'id': id, 'i': i, 'sec': i % 60}
+                       for i in range(num_comments))
+    return POST % {'id': id, 'body': 'x' * body_size,
+                   'num_comments': num_comments, 'media': media,
+                   'comments': comments}
+
+
+def posts_xml(num_posts, num_comments=2, num_media=1, body_size=200):
+    """Returns a readposts response with the given number of posts."""
+    return rsp(post_xml(id, num_comments, num_media, body_size)
+               for id in xrange(1, num_posts + 1))
+
+
+def sites_xml(num_sites, num_posts=0):
+    """Returns a getsites response with the given number of sites."""
+    return rsp(SITE % {'id': id, 'primary': str(id == 1).lower(),
+                       'num_posts': num_posts}
+               for id in xrange(1, num_sites + 1))
+
+
+def rsp(elements):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<rsp stat="ok">%s\n</rsp>' \
+           % ''.join(elements)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the API on 127.0.0.1 from a background thread.
+
+    'num_sites'    - The number of sites getsites returns.
+    'num_posts'    - The number of posts every site has.
+    'num_comments' - The comments of every post.
+    'num_media'    - The media of every post.
+    'body_size'    - The number of characters in a post's body.
+    'media_size'   - The number of bytes in a media file, which are 
+                     served by the server too.
+    'latency'      - Seconds every response is delayed by.
+    'port'         - The port to listen on; by default a free one.
+
+    Connections are kept alive. The requested paths are counted in
+    'requests' (all media files as '/getfile').
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, num_sites=2, num_posts=100, num_comments=2,
+                 num_media=1, body_size=200, media_size=1024, latency=0,
+                 port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.num_sites = num_sites
+        self.num_posts = num_posts
+        self.num_comments = num_comments
+        self.num_media = num_media
+        self.body_size = body_size
+        self.media_size = media_size
+        self.latency = latency
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+        self.requests = {}
+        self._posts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts serving in a daemon thread and returns the server."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def getsites(self, params):
+        return sites_xml(self.num_sites, self.num_posts)
+
+    def readposts(self, params):
+        per_page = int(params.get('num_posts') or 10)
+        first = (int(params.get('page') or 1) - 1) * per_page
+        last = min(first + per_page, self.num_posts)
+        return rsp(self._post(id) for id in xrange(first + 1, last + 1))
+
+    def getpost(self, params):
+        id = params.get('id', '')
+        if not id.isdigit() or not 0 < int(id) <= self.num_posts:
+            return ERROR % (3001, 'Invalid post')
+        return rsp([self._post(int(id))])
+
+    def _post(self, id):
+        # the posts are generated once, so serving them costs little
+        xml = self._posts.get(id)
+        if xml is None:
+            xml = self._posts[id] = post_xml(id, self.num_comments,
+                                             self.num_media, self.body_size,
+                                             self.url)
+        return xml
+
+    def _count(self, path):
+        self._lock.acquire()
+        try:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        finally:
+            self._lock.release()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # otherwise the end of a response waits for the client's delayed ACK
+    # on kept-alive connections (Nagle's algorithm)
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    methods = {'/api/getsites': 'getsites', '/api/readposts': 'readposts',
+               '/api/getpost': 'getpost'}
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self._respond(path, dict(urlparse.parse_qsl(query)))
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        path = self.path.partition('?')[0]
+        self._respond(path, dict(urlparse.parse_qsl(data)))
+
+    def _respond(self, path, params):
+        server = self.server
+        if path.startswith('/getfile/'):
+            server._count('/getfile')
+        else:
+            server._count(path)
+        if server.latency:
+            time.sleep(server.latency)
+        if path in self.methods:
+            status = 200
+            body = getattr(server, self.methods[path])(params)
+        elif path.startswith('/getfile/'):
+            status = 200
+            body = 'x' * server.media_size
+        else:
+            status = 404
+            body = ERROR % (404, 'Not found')
+        self.send_response(status)
+        if status == 200 and path.startswith('/getfile/'):
+            self.send_header('Content-Type', 'application/octet-stream')
+        else:
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    opt_parser = OptionParser()
+    opt_parser.add_option("-p", "--port", type="int", dest="port",
+        default=8080, help="Port to listen on. Default is 8080")
+    opt_parser.add_option("-s", "--sites", type="int", dest="num_sites",
+        default=2, help="Number of sites. Default is 2")
+    opt_parser.add_option("-n", "--posts", type="int", dest="num_posts",
+        default=100, help="Number of posts per site. Default is 100")
+    opt_parser.add_option("-c", "--comments", type="int", dest="num_comments",
+        default=2, help="Number of comments per post. Default is 2")
+    opt_parser.add_option("-m", "--media", type="int", dest="num_media",
+        default=1, help="Number of media per post. Default is 1")
+    opt_parser.add_option("-b", "--body-size", type="int", dest="body_size",
+        default=200, help="Characters in a post's body. Default is 200")
+    opt_parser.add_option("--media-size", type="int", dest="media_size",
+        default=1024, help="Bytes in a media file. Default is 1024")
+    opt_parser.add_option("-l", "--latency", type="float", dest="latency",
+        default=0, help="Seconds every response is delayed by. Default is 0")
+    (options, args) = opt_parser.parse_args()
+
+    server = MockServer(options.num_sites, options.num_posts,
+                        options.num_comments, options.num_media,
+                        options.body_size, options.media_size, 
+                        options.latency, options.port)
+    print "Serving the Posterous API at %s/api" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -7,13 +7,59 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
+import os
+
+from posterous.download import Downloader, file_name
 from posterous.utils import parse_datetime
 
 
 class Model(object):
     """ Base class """
+    # subclasses without __slots__ get an instance dict for their attributes
+    __slots__ = ('_api',)
+
     def __init__(self, api=None):
         self._api = api
+
+    def __getattr__(self, name):
+        # Only called for missing attributes. Parsers may store the text 
+        # of an attribute with its cast function, to cast it only when it 
+        # is accessed for the first time, or keep the whole source element 
+        # to build the attribute from (see LazyModelParser).
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            cast, text = getattr(self, '_lazy_' + name)
+        except AttributeError:
+            try:
+                source = getattr(self, '_source')
+            except AttributeError:
+                raise AttributeError(name)
+            return source[0].materialize(self, name)
+        value = cast(text)
+        setattr(self, name, value)
+        try:
+            delattr(self, '_lazy_' + name)
+        except AttributeError:
+            pass
+        return value
+
+    def __getstate__(self):
+        # the api can't be pickled and is set again when loading from a cache
+        self._load_source()
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._api = None
+
+    def _load_source(self):
+        # source elements can't be pickled, so all attributes are built
+        try:
+            source = getattr(self, '_source')
+        except AttributeError:
+            return
+        source[0].materialize_all(self)
  
     @classmethod
     def parse(self, api, json):
@@ -36,9 +82,9 @@ class Post(Model):
         post = self(api)
         for k, v in json.iteritems():
             if k == 'media':
-                setattr(post, k, Media.parse(api, v))
+                setattr(post, k, self.media_model.parse(api, v))
             elif k == 'comments':
-                setattr(post, k, Comment.parse(api, v))
+                setattr(post, k, self.comment_model.parse(api, v))
             else: 
                 setattr(post, k, v)
         return post
@@ -61,6 +107,9 @@ class Site(Model):
     def read_posts(self, **kwargs):
         return self._api.read_posts(self.id, **kwargs)
 
+    def iter_posts(self, **kwargs):
+        return self._api.iter_posts(site_id=self.id, **kwargs)
+
     def new_post(self, *args, **kwargs):
         return self._api.new_post(self.id, *args, **kwargs)
 
@@ -99,16 +148,105 @@ class Media(Model):
         media = obj or self(api)
         for k, v in json.iteritems():
             if k == 'medium':
-                Media.parse_obj(api, v, media)
-            elif k == 'thumb':
-                setattr(media, k, Media.parse_obj(api, v))
+                self.parse_obj(api, v, media)
+            elif k == 'thumb' and isinstance(v, dict):
+                # videos have the thumbnail's url only
+                setattr(media, k, self.parse_obj(api, v))
             else:
                 setattr(media, k, v)
         return media
 
-    def download(self):
-        # TODO: download file
-        pass
+    def download(self, path='.', checksum=None):
+        """
+        Saves the file to 'path', or into 'path' if it's a folder, and 
+        returns the name of the file. See Downloader.download.
+        """
+        url = self.url
+        if os.path.isdir(path):
+            path = os.path.join(path, file_name(url))
+        downloader = self._api and self._api.downloader or Downloader()
+        downloader.download(url, path, checksum)
+        return path
+
+
+Post.media_model = Media
+Post.comment_model = Comment
+
+
+class CompactModel(Model):
+    """
+    Base class for models which keep their known attributes in __slots__
+    instead of an instance dict, to save memory when holding many of them.
+    Attributes without a slot are kept in the '_extra' dict, which is only 
+    created when needed.
+    """
+    __slots__ = ('_extra',)
+
+    def __init__(self, api=None):
+        self._api = api
+        self._extra = None
+
+    def __setattr__(self, name, value):
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[name] = value
+
+    def __getattr__(self, name):
+        # only called for attributes without a (set) slot
+        if name != '_extra' and self._extra and name in self._extra:
+            return self._extra[name]
+        return Model.__getattr__(self, name)
+
+    def __delattr__(self, name):
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            if not self._extra or name not in self._extra:
+                raise
+            del self._extra[name]
+
+    def __getstate__(self):
+        self._load_source()
+        state = dict(self._extra or {})
+        for name in self.__slots__:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        self._api = None
+        self._extra = None
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+
+
+def compact_model(model, fields):
+    """Returns a CompactModel class with the methods of the model class"""
+    attrs = dict((k, v) for k, v in model.__dict__.iteritems() 
+                 if k not in ('__dict__', '__weakref__', '__slots__'))
+    attrs['__slots__'] = tuple(fields)
+    return type('Compact' + model.__name__, (CompactModel,), attrs)
+
+
+CompactPost = compact_model(Post, (
+    'id', 'url', 'link', 'title', 'body', 'date', 'views', 'private', 
+    'author', 'authorpic', 'commentsenabled', 'commentscount', 'media', 
+    'comments'))
+CompactSite = compact_model(Site, (
+    'id', 'name', 'url', 'hostname', 'private', 'primary', 'commentsenabled', 
+    'num_posts'))
+CompactComment = compact_model(Comment, (
+    'body', 'date', 'author', 'authorpic'))
+CompactTag = compact_model(Tag, ('id', 'tag_string', 'count'))
+CompactMedia = compact_model(Media, (
+    'type', 'url', 'filesize', 'height', 'width', 'thumb', 'artist', 
+    'album', 'song', 'flv', 'mp4'))
+
+CompactPost.media_model = CompactMedia
+CompactPost.comment_model = CompactComment
 
 
 class JSONModel(Model):
@@ -128,11 +266,23 @@ class ModelFactory(object):
     media = Media
     json = JSONModel
 
+
+class CompactModelFactory(ModelFactory):
+    """
+    Creates compact models, which use much less memory per instance. 
+    Use it with ModelParser(CompactModelFactory).
+    """
+    post = CompactPost
+    site = CompactSite
+    comment = CompactComment
+    tag = CompactTag
+    media = CompactMedia
+
 """Used to cast response tags to the correct type"""
 attribute_map = {
     ('id', 'views', 'count', 'filesize', 'height', 'width', 'commentscount', 
      'num_posts'): int,
     ('private', 'commentsenabled', 'primary'): lambda v: v.lower() == 'true',
-    ('date'): lambda v: parse_datetime(v)
+    ('date',): parse_datetime
 }
 
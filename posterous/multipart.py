@@ -0,0 +1,162 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import mimetypes
+import os
+import uuid
+
+
+class File(object):
+    """
+    The name of a file to upload. Strings passed as files are sent as 
+    they are, so a file name must be wrapped in File.
+
+    Example:
+        api.new_post(title='Jellyfish', media=File('jellyfish.png'))
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return 'File(%r)' % (self.path,)
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body that is read in chunks, so files
+    are streamed from disk instead of being loaded into memory.
+
+    'fields'   - A list of (name, value) tuples.
+    'files'    - The names of the fields whose values are sent as files.
+                 A value may be file data, a File or an open file.
+    'progress' - Called with the number of bytes sent so far and the
+                 total size of the body after every chunk.
+    """
+    def __init__(self, fields, files=(), progress=None, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.progress = progress
+        self._parts = []
+        for name, value in fields:
+            if name in files:
+                part = _FilePart(value)
+                self._parts.append(
+                    '--%s\r\nContent-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\nContent-Type: %s\r\n\r\n' %
+                    (self.boundary, name, part.filename, part.content_type))
+                self._parts.append(part)
+                self._parts.append('\r\n')
+            else:
+                self._parts.append(
+                    '--%s\r\nContent-Disposition: form-data; name="%s"'
+                    '\r\n\r\n%s\r\n' % (self.boundary, name, value))
+        self._parts.append('--%s--\r\n' % self.boundary)
+        self._length = sum(len(part) for part in self._parts)
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            amt = self._length
+        chunks = []
+        size = 0
+        while size < amt and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, str):
+                data = part[self._pos:self._pos + amt - size]
+                self._pos += len(data)
+                done = self._pos >= len(part)
+            else:
+                data = part.read(amt - size)
+                done = not data
+            if data:
+                chunks.append(data)
+                size += len(data)
+            if done:
+                if not isinstance(part, str):
+                    part.close()
+                self._index += 1
+                self._pos = 0
+
+        self._sent += size
+        if self.progress and size:
+            self.progress(self._sent, self._length)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        """Rewinds the body, so a failed request can be sent again."""
+        if offset or whence:
+            raise IOError('A multipart body can only be rewound')
+        self.close()
+        self._index = 0
+        self._pos = 0
+        self._sent = 0
+
+    def close(self):
+        for part in self._parts:
+            if not isinstance(part, str):
+                part.close()
+
+
+class _FilePart(object):
+    """File data, a File or an open file, read from its start."""
+    def __init__(self, value):
+        self._file = None
+        self._opened = False
+        if hasattr(value, 'read'):
+            self._file = value
+            self._start = value.tell()
+            name = getattr(value, 'name', None)
+            if not isinstance(name, basestring):
+                # e.g. temporary files, or files opened by descriptor
+                name = 'media'
+            try:
+                self._size = os.fstat(value.fileno()).st_size - self._start
+            except (AttributeError, IOError, OSError):
+                value.seek(0, 2)
+                self._size = value.tell() - self._start
+        elif isinstance(value, File):
+            self._path = value.path
+            self._size = os.path.getsize(value.path)
+            name = value.path
+        else:
+            self._data = value
+            self._size = len(value)
+            name = 'media'
+        self.filename = os.path.basename(name).replace('"', '')
+        if isinstance(self.filename, unicode):
+            self.filename = self.filename.encode('utf-8')
+        self.content_type = mimetypes.guess_type(self.filename)[0] or \
+                            'application/octet-stream'
+
+    def __len__(self):
+        return self._size
+
+    def read(self, amt):
+        if not self._opened:
+            self._opened = True
+            if self._file is not None:
+                self._file.seek(self._start)
+            elif hasattr(self, '_path'):
+                self._file = open(self._path, 'rb')
+            else:
+                self._pos = 0
+        if self._file is None:
+            data = self._data[self._pos:self._pos + amt]
+            self._pos += len(data)
+            return data
+        return self._file.read(amt)
+
+    def close(self):
+        if self._opened and hasattr(self, '_path') and self._file is not None:
+            self._file.close()
+            self._file = None
+        self._opened = False
@@ -7,20 +7,45 @@
 #    the terms of the Apache License Version 2.0 available at 
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
+import time
 import xml.etree.cElementTree as ET
 
 from posterous.models import ModelFactory, attribute_map
-from posterous.utils import import_simplejson
+from posterous.utils import import_json_decoder, enc_utf8_str
 from posterous.error import PosterousError
 
 
+# the fastest JSON decoder available, see import_json_decoder
+json_loads = import_json_decoder()
+
+
+# Maps a tag name to the function casting the text of its elements.
+# Filled from models.attribute_map; use register_type to extend it.
+casters = {}
+
+
+def register_type(names, cast):
+    """
+    Registers a function which is called with the text of every element
+    named 'names' (a tag name or a tuple of them) and returns its value.
+    Replaces the function registered before for the same name.
+    """
+    if isinstance(names, basestring):
+        names = (names,)
+    for name in names:
+        casters[name.lower()] = cast
+
+for names, cast in attribute_map.iteritems():
+    register_type(names, cast)
+
+
 def set_type(name, value):
     """Sets the value to the appropriate type."""
-    for names in attribute_map:
-        if name in names:
-            return attribute_map.get(names)(value)
-    # most likely a string
-    return value
+    cast = casters.get(name)
+    if cast is None or not value:
+        # most likely a string, or an empty element like <views></views>
+        return value
+    return cast(value)
 
  
 class XMLDict(dict):
@@ -30,23 +55,35 @@ class XMLDict(dict):
     read since they don't appear in any current Posterous API
     response. Returns a dictionary of objects.
 
+    The text of single elements named in 'lazy_types' isn't cast, but 
+    stored with its cast function under '_lazy_<tag>', so the model can
+    cast it on first access (see Model.__getattr__). If 'fields' is given,
+    only the children with these tags are read.
+
     Modified from: http://code.activestate.com/recipes/410469/
     """
-    def __init__(self, parent_element):
-        childrenNames = list((child.tag for child in parent_element))
+    def __init__(self, parent_element, lazy_types=(), fields=None):
+        # count the siblings per tag up front, so grouping them is a lookup
+        tag_count = {}
+        for child in parent_element:
+            tag = child.tag.lower()
+            tag_count[tag] = tag_count.get(tag, 0) + 1
 
         for element in parent_element:
             tag = element.tag.lower()
+            if fields is not None and tag not in fields:
+                continue
             if element:
                 if len(element) == 1 or element[0].tag != element[1].tag:
                     # we assume that if the first two tags in a series are 
                     # different, then they are all different.
-                    aDict = XMLDict(element)
+                    aDict = XMLDict(element, lazy_types)
                 else:
                     # treat like list 
-                    aDict = {element[0].tag.lower(): XMLList(element)}
+                    aDict = {element[0].tag.lower(): 
+                             XMLList(element, lazy_types)}
                 
-                if childrenNames.count(tag) > 1:
+                if tag_count[tag] > 1:
                     # there are multiple siblings with this tag, so they 
                     # must be grouped together
                     try:
@@ -59,8 +96,13 @@ class XMLDict(dict):
                     self.update({tag: aDict})
             else:
                 # finally, if there are no child tags, extract the text
-                value = set_type(tag, element.text.strip()) 
-                if childrenNames.count(tag) > 1:
+                text = (element.text or '').strip()
+                if text and tag in lazy_types and tag_count[tag] == 1 and \
+                   tag in casters:
+                    self['_lazy_' + tag] = (casters[tag], text)
+                    continue
+                value = set_type(tag, text)
+                if tag_count[tag] > 1:
                     # there are multiple instances of this tag, so they 
                     # must be grouped together
                     try:
@@ -80,13 +122,13 @@ class XMLList(list):
 
     Modified from: http://code.activestate.com/recipes/410469/
     """
-    def __init__(self, aList):
+    def __init__(self, aList, lazy_types=()):
         for element in aList:
             if element:
                 if len(element) == 1 or element[0].tag != element[1].tag:
-                    self.append(XMLDict(element))
+                    self.append(XMLDict(element, lazy_types))
                 else:
-                    self.append(XMLList(element))
+                    self.append(XMLList(element, lazy_types))
             elif element.text:
                 text = set_type(element.tag.lower(), element.text.strip())
                 if text:
@@ -94,11 +136,14 @@ class XMLList(list):
 
 
 class XMLParser(object):
-    def __init__(self):
-        pass
+    def __init__(self, lazy_types=()):
+        self.lazy_types = lazy_types
 
-    def parse(self, method, payload):
-        """Parses the XML payload and returns a dict of objects"""
+    def root(self, method, payload):
+        """
+        Returns the root element of the XML payload, after verifying that 
+        the response was successful.
+        """
         root = ET.XML(payload)
         
         if root.tag != 'rsp':
@@ -109,28 +154,74 @@ class XMLParser(object):
         if root.get('stat') == 'fail':
             error = root[0]
             self.parse_error(error)
-        else:
-            # There are nesting inconsistencies in the response XML 
-            # with some tags appearing below the payload model element. 
-            # This is a problem when the payload_type is _not_ a list.
-            # If the root has multiple children, all siblings of the first
-            # child will be moved under said child.
-            if not method.payload_list and len(root) > 1:
-                for node in root[1:]:
-                    root[0].append(node)
-                    root.remove(node)
-            
-            if method.payload_list:
-                # A list of results is expected
-                result = []
-                for node in root:
-                    result.append(XMLDict(node))
-            else:
-                # Move to the first child before parsing the tree
-                result = XMLDict(root[0])
+
+        # There are nesting inconsistencies in the response XML 
+        # with some tags appearing below the payload model element. 
+        # This is a problem when the payload_type is _not_ a list.
+        # If the root has multiple children, all siblings of the first
+        # child will be moved under said child.
+        if not method.payload_list and len(root) > 1:
+            for node in root[1:]:
+                root[0].append(node)
+                root.remove(node)
+        return root
+
+    def parse(self, method, payload):
+        """Parses the XML payload and returns a dict of objects"""
+        root = self.root(method, payload)
+        fields = getattr(method, 'fields', None)
             
-            # Make sure the values are formatted properly
-            return self.cleanup(result)
+        if method.payload_list:
+            # A list of results is expected
+            result = []
+            for node in root:
+                result.append(XMLDict(node, self.lazy_types, fields))
+        else:
+            # Move to the first child before parsing the tree
+            result = XMLDict(root[0], self.lazy_types, fields)
+        
+        # Make sure the values are formatted properly
+        return self.cleanup(result)
+
+    def iterelements(self, stream):
+        """
+        Incrementally parses the XML read from the file-like stream and 
+        yields every payload element as soon as its closing tag arrives. 
+        Processed elements are discarded, so only one payload element is 
+        kept in memory at a time.
+        """
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                    if root.tag != 'rsp':
+                        raise PosterousError('XML response is missing the ' \
+                                             'status tag! The response may ' \
+                                             'be malformed.')
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if root.get('stat') == 'fail':
+                self.parse_error(element)
+
+            yield element
+            # drop the parsed element from the tree
+            root.clear()
+
+    def iterparse(self, method, stream):
+        """
+        Like iterelements, but yields a dict of objects for every 
+        payload element.
+        """
+        fields = getattr(method, 'fields', None)
+        for element in self.iterelements(stream):
+            yield self.cleanup(XMLDict(element, self.lazy_types, fields))
 
     def parse_error(self, error):
         raise PosterousError(error.get('msg'), error.get('code'))
@@ -159,11 +250,89 @@ class XMLParser(object):
         return output
 
 
+class JSONParser(object):
+    """
+    Decodes JSON payloads into the same dicts of objects as XMLParser: 
+    the keys are lower case, string values are cast like the text of XML
+    elements and comments and media are lists. A payload with a 'stat' 
+    of 'fail' raises its 'err' as a PosterousError.
+    """
+    def __init__(self, lazy_types=()):
+        self.lazy_types = lazy_types
+
+    def parse(self, method, payload):
+        data = json_loads(payload)
+        if isinstance(data, dict) and data.get('stat') == 'fail':
+            error = data.get('err') or {}
+            raise PosterousError(error.get('msg'), error.get('code'))
+
+        fields = getattr(method, 'fields', None)
+        if method.payload_list:
+            if not isinstance(data, list):
+                data = [data]
+            return [self.clean(obj, fields) for obj in data]
+        return self.clean(data, fields)
+
+    def clean(self, obj, fields=None):
+        if type(obj) is not dict:
+            return obj
+        result = {}
+        for key, value in obj.iteritems():
+            tag = _json_tags.get(key)
+            if tag is None:
+                tag = enc_utf8_str(key).lower()
+                if len(_json_tags) < 1000:
+                    _json_tags[key] = tag
+            if fields is not None and tag not in fields:
+                continue
+            value_type = type(value)
+            if value_type is dict:
+                value = self.clean(value)
+            elif value_type is list:
+                value = [self.clean(v) for v in value]
+            elif tag in casters and isinstance(value, basestring) and value:
+                if tag in self.lazy_types:
+                    result['_lazy_' + tag] = (casters[tag], value)
+                    continue
+                value = casters[tag](value)
+            result[tag] = value
+
+        # comments and media are always lists, as in XMLParser.cleanup
+        if 'comment' in result:
+            result.setdefault('comments', result.pop('comment'))
+        for tag in ('comments', 'media'):
+            if tag in result and not isinstance(result[tag], list):
+                result[tag] = [result[tag]]
+        return result
+
+
+# JSON keys and their tag names, so the keys aren't encoded every time
+_json_tags = {}
+
+
+def parse_payload(method, payload, lazy_types=()):
+    """Returns the dicts of objects in an XML or JSON payload"""
+    if method.response_type == 'json' and payload.lstrip()[:1] != '<':
+        return JSONParser(lazy_types).parse(method, payload)
+    elif method.response_type in ('xml', 'json'):
+        # servers answer in XML if they don't offer JSON for a method
+        return XMLParser(lazy_types).parse(method, payload)
+    raise PosterousError('Unsupported response type: %s' % 
+                         method.response_type)
+
+
 class ModelParser(object):
-    """Used for parsing a method response into a model object."""
+    """
+    Used for parsing a method response into a model object.
+
+    The values of the tags in 'lazy_types' (e.g. ('date',)) are only cast
+    when the model attribute is first accessed. If the method was called
+    with 'fields', the other tags of the payload models are skipped.
+    """
 
-    def __init__(self, model_factory=None):
+    def __init__(self, model_factory=None, lazy_types=()):
         self.model_factory = model_factory or ModelFactory
+        self.lazy_types = lazy_types
 
     def parse(self, method, payload):
         # Get the appropriate model for this payload
@@ -172,16 +341,249 @@ class ModelParser(object):
                 return
             model = getattr(self.model_factory, method.payload_type)
         except AttributeError:
-            raise Exception('No model for this payload type: %s' % 
-                            method.payload_type)
+            raise PosterousError('No model for this payload type: %s' % 
+                                 method.payload_type)
 
-        # The payload XML must be parsed into a dict of objects before
+        # The payload must be parsed into a dict of objects before
         # being used in the model.
-        if method.response_type == 'xml':
-            xml_parser = XMLParser()
-            data = xml_parser.parse(method, payload)
+        timings = getattr(method, 'timings', None)
+        if timings is not None:
+            started = time.time()
+        data = parse_payload(method, payload, self.lazy_types)
+        if timings is not None:
+            timings['parse'] = time.time() - started
+        return model.parse(method.api, data)
+
+    def parse_stream(self, method, stream):
+        """
+        Parses a response of a list method read from the file-like stream,
+        yielding each model as soon as it has been received.
+        """
+        if method.payload_type is None:
+            return
+        try:
+            model = getattr(self.model_factory, method.payload_type)
+        except AttributeError:
+            raise PosterousError('No model for this payload type: %s' % 
+                                 method.payload_type)
+
+        if method.response_type == 'json':
+            # decoded at once; there's no incremental JSON decoder
+            for obj in self.parse(method, stream.read()):
+                yield obj
+            return
+        if method.response_type != 'xml':
+            raise PosterousError('Unsupported response type: %s' % 
+                                 method.response_type)
+
+        for data in XMLParser(self.lazy_types).iterparse(method, stream):
+            yield model.parse_obj(method.api, data)
+
+
+class DirectModelParser(object):
+    """
+    Builds the models straight from the XML elements in a single pass, 
+    skipping the XMLDict representation used by ModelParser. The models
+    are the same as those of ModelParser, which also describes 'lazy_types'.
+    """
+
+    def __init__(self, model_factory=None, lazy_types=()):
+        self.model_factory = model_factory or ModelFactory
+        self.lazy_types = lazy_types
+
+    def parse(self, method, payload):
+        model = self._model(method)
+        if model is None:
+            return
+        timings = getattr(method, 'timings', None)
+        if timings is not None:
+            started = time.time()
+        if method.response_type == 'json':
+            # already decoded into objects, so there's nothing to skip
+            data = parse_payload(method, payload, self.lazy_types)
+            if timings is not None:
+                timings['parse'] = time.time() - started
+            return model.parse(method.api, data)
+        root = XMLParser().root(method, payload)
+        if timings is not None:
+            timings['parse'] = time.time() - started
+        fields = getattr(method, 'fields', None)
+
+        if method.payload_list:
+            return [self.build(model, method.api, node, fields=fields) 
+                    for node in root]
+        return self.build(model, method.api, root[0], fields=fields)
+
+    def parse_stream(self, method, stream):
+        model = self._model(method)
+        if model is None:
+            return
+        if method.response_type == 'json':
+            for obj in self.parse(method, stream.read()):
+                yield obj
+            return
+        fields = getattr(method, 'fields', None)
+        for element in XMLParser().iterelements(stream):
+            yield self.build(model, method.api, element, fields=fields)
+
+    def build(self, model, api, element, obj=None, fields=None):
+        """
+        Sets the children of the element as attributes of a new model 
+        instance, or of 'obj' if given. Only the children with the tags 
+        in 'fields' are read, if given.
+        """
+        if obj is None:
+            obj = model(api)
+        factory = self.model_factory
+        is_media = model is factory.media
+        seen = set()
+        grouped = set()
+
+        for child in element:
+            tag = child.tag.lower()
+            if fields is not None and tag not in fields:
+                continue
+            # comments and media are always lists, as in XMLParser.cleanup
+            if tag == 'comment':
+                if not hasattr(obj, 'comments'):
+                    obj.comments = []
+                obj.comments.append(self.build(factory.comment, api, child))
+                continue
+            if tag == 'media':
+                if not hasattr(obj, 'media'):
+                    obj.media = []
+                obj.media.append(self.build(factory.media, api, child))
+                continue
+
+            if len(child):
+                if is_media and tag == 'medium':
+                    # merged into the media object, see Media.parse_obj
+                    self.build(model, api, child, obj)
+                    continue
+                if is_media and tag == 'thumb':
+                    value = self.build(factory.media, api, child)
+                elif len(child) == 1 or child[0].tag != child[1].tag:
+                    value = XMLDict(child, self.lazy_types)
+                else:
+                    value = {child[0].tag.lower(): 
+                             XMLList(child, self.lazy_types)}
+            else:
+                value = (child.text or '').strip()
+                if value and tag in self.lazy_types and tag in casters:
+                    setattr(obj, '_lazy_' + tag, (casters[tag], value))
+                    continue
+                value = set_type(tag, value)
+
+            if tag in grouped:
+                getattr(obj, tag).append(value)
+            elif tag in seen:
+                # siblings with the same tag are grouped in a list
+                setattr(obj, tag, [getattr(obj, tag), value])
+                grouped.add(tag)
+            else:
+                seen.add(tag)
+                setattr(obj, tag, value)
+        return obj
+
+    def _model(self, method):
+        if method.response_type not in ('xml', 'json'):
+            raise PosterousError('Unsupported response type: %s' % 
+                                 method.response_type)
+        if method.payload_type is None:
+            return
+        try:
+            return getattr(self.model_factory, method.payload_type)
+        except AttributeError:
+            raise PosterousError('No model for this payload type: %s' % 
+                                 method.payload_type)
+
+
+
+class LazyModelParser(DirectModelParser):
+    """
+    Returns models which keep their XML element and only build an attribute,
+    casting its value or creating its nested models, when it is accessed
+    for the first time. Listing the titles of many posts then doesn't pay
+    for their bodies, media and comments.
+    """
+
+    def build(self, model, api, element, obj=None, fields=None):
+        obj = model(api)
+        if fields is None:
+            # the children are indexed by tag on the first attribute access
+            index = None
         else:
-            raise NotImplementedError
+            index = self._index(element, model is self.model_factory.media,
+                                fields)
+        obj._source = (self, element, index)
+        return obj
 
-        return model.parse(method.api, data)
+    def materialize(self, obj, name):
+        """
+        Builds the attribute 'name' of a model returned by this parser and
+        sets it on the model. Raises AttributeError if there's no such child.
+        """
+        parser, element, index = obj._source
+        factory = self.model_factory
+        if index is None:
+            index = self._index(element, isinstance(obj, factory.media))
+            obj._source = (parser, element, index)
+
+        # comments and media are always lists, as in XMLParser.cleanup
+        if name == 'comments':
+            children = index.get('comment')
+            model = factory.comment
+        elif name == 'media':
+            children = index.get('media')
+            model = factory.media
+        elif name == 'comment':
+            children = None
+        else:
+            children = index.get(name)
+            model = None
+        if not children:
+            raise AttributeError(name)
+
+        if model is not None:
+            value = [self.build(model, obj._api, child) for child in children]
+        else:
+            value = [self._value(obj, child) for child in children]
+            # siblings with the same tag are grouped in a list
+            if len(value) == 1:
+                value = value[0]
+        setattr(obj, name, value)
+        return value
+
+    def materialize_all(self, obj):
+        """Builds all attributes of the model and drops its element."""
+        index = obj._source[2]
+        if index is None:
+            index = self._index(obj._source[1], 
+                                isinstance(obj, self.model_factory.media))
+        for tag in index:
+            name = tag == 'comment' and 'comments' or tag
+            getattr(obj, name)
+        del obj._source
+
+    def _index(self, element, is_media, fields=None):
+        index = {}
+        for child in element:
+            tag = child.tag.lower()
+            if fields is not None and tag not in fields:
+                continue
+            if is_media and tag == 'medium' and len(child):
+                # merged into the media object, see Media.parse_obj
+                index.update(self._index(child, True))
+            else:
+                index.setdefault(tag, []).append(child)
+        return index
 
+    def _value(self, obj, child):
+        if len(child):
+            if child.tag.lower() == 'thumb' and \
+               isinstance(obj, self.model_factory.media):
+                return self.build(self.model_factory.media, obj._api, child)
+            if len(child) == 1 or child[0].tag != child[1].tag:
+                return XMLDict(child, self.lazy_types)
+            return {child[0].tag.lower(): XMLList(child, self.lazy_types)}
+        return set_type(child.tag.lower(), (child.text or '').strip())
@@ -0,0 +1,212 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+from posterous.transport import Transport
+
+# methods that may be sent again if it's unknown whether the server got them
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+                                'TRACE'])
+
+
+class ConnectionPool(Transport):
+    """
+    Keeps persistent (keep-alive) HTTP connections open per host, so that
+    consecutive API calls don't pay for a new TCP and TLS handshake.
+
+    'maxsize'      - The maximum number of connections opened to a single
+                     host. Callers block until a connection is available.
+    'idle_timeout' - Seconds an unused connection is kept open. Older
+                     connections are closed instead of being reused.
+                     None keeps them open forever.
+    'timeout'      - The socket timeout passed to the connections.
+    """
+    def __init__(self, maxsize=4, idle_timeout=60, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """
+        Sends the request on a pooled connection and returns a
+        PooledResponse. The connection goes back to the pool once the
+        response has been read completely or closed. The response's
+        'connect_time' is the seconds it took to open a new connection.
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        key = (scheme, netloc)
+        path = path or '/'
+        if query:
+            path = '%s?%s' % (path, query)
+
+        slot = self._slot(key)
+        slot.acquire()
+        try:
+            conn, reused = self._get_conn(key)
+            connect_time = 0
+            sent = False
+            try:
+                if not reused:
+                    connect_time = self._connect(conn)
+                conn.request(method, path, body, headers or {})
+                sent = True
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the server may have dropped the idle connection, in which
+                # case the request is sent again on a fresh one; unless the
+                # server might have acted on a request that isn't idempotent
+                if not reused or not _is_stale(e) or \
+                   (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn = self._new_conn(key)
+                connect_time = self._connect(conn)
+                resp = self._send(conn, method, path, body, headers)
+        except:
+            slot.release()
+            raise
+
+        return PooledResponse(self, key, conn, resp, connect_time)
+
+    def clear(self):
+        """Closes all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def _connect(self, conn):
+        """Opens the connection and returns the seconds it took."""
+        started = time.time()
+        conn.connect()
+        return time.time() - started
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        return conn.getresponse()
+
+    def _slot(self, key):
+        self._lock.acquire()
+        try:
+            if key not in self._slots:
+                self._slots[key] = threading.Semaphore(self.maxsize)
+            return self._slots[key]
+        finally:
+            self._lock.release()
+
+    def _get_conn(self, key):
+        """Returns a tuple of a connection and whether it was reused."""
+        now = time.time()
+        expired = []
+        conn = None
+
+        self._lock.acquire()
+        try:
+            conns = self._idle.get(key, [])
+            while conns:
+                candidate, last_used = conns.pop()
+                if self.idle_timeout is not None and \
+                   now - last_used >= self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        finally:
+            self._lock.release()
+
+        for candidate in expired:
+            candidate.close()
+
+        if conn is None:
+            return self._new_conn(key), False
+        return conn, True
+
+    def _new_conn(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            self._lock.acquire()
+            try:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            finally:
+                self._lock.release()
+        else:
+            conn.close()
+        self._slot(key).release()
+
+
+def _is_stale(error):
+    """
+    Whether the error shows that the server closed the connection before
+    it sent any part of a response. Timeouts never do.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and \
+           not isinstance(error, socket.timeout) and \
+           error.args[:1] in ((errno.ECONNRESET,), (errno.EPIPE,))
+
+
+class PooledResponse(object):
+    """
+    Wraps a httplib response and hands the connection back to its
+    pool as soon as the body has been consumed.
+    """
+    def __init__(self, pool, key, conn, resp, connect_time=0):
+        self.status = resp.status
+        self.reason = resp.reason
+        self.msg = resp.msg
+        self.connect_time = connect_time
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._released = False
+
+    def getheader(self, name, default=None):
+        return self._resp.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self._resp.read(amt)
+        except:
+            self._release(False)
+            raise
+        if not data or self._resp.isclosed():
+            self._release(not self._resp.will_close)
+        return data
+
+    def close(self):
+        # unread data left on the socket makes the connection unusable
+        self._release(False)
+
+    def _release(self, reusable):
+        if not self._released:
+            self._released = True
+            self._pool._release(self._key, self._conn, reusable)
@@ -0,0 +1,121 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from posterous.error import PosterousError
+
+
+class TokenBucket(object):
+    """
+    Limits the requests to 'rate' per second on average, allowing bursts
+    of up to 'capacity' requests. Share one bucket between API instances
+    to limit them together.
+
+    When the server throttles a request, all requests are paused for the
+    delay it asked for and the rate is halved, down to 'min_rate'. Every
+    successful request then raises it a little, back up to 'rate'.
+    """
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.max_rate = float(rate)
+        self.capacity = capacity or max(1.0, self.max_rate)
+        self.min_rate = min_rate or self.max_rate / 16
+        self.rate = self.max_rate
+        self.tokens = float(self.capacity)
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be made."""
+        while True:
+            wait = self._update(self._take)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def throttled(self, delay):
+        """Called when the server asked to wait 'delay' seconds."""
+        def throttle(now):
+            self.paused_until = max(self.paused_until, now + delay)
+            self.rate = max(self.min_rate, self.rate / 2)
+            # no burst once the pause is over
+            self.tokens = 0.0
+            self.updated = self.paused_until
+        self._update(throttle)
+
+    def succeeded(self):
+        """Called after every request the server didn't throttle."""
+        def recover(now):
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+        self._update(recover)
+
+    def _take(self, now):
+        """Takes a token and returns 0, or the seconds to wait for one."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _update(self, func):
+        """Calls func with the current time while holding the lock."""
+        self._lock.acquire()
+        try:
+            return func(time.time())
+        finally:
+            self._lock.release()
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    A TokenBucket whose state is kept in the file at 'path', so that all
+    processes using the same file share the limit. Needs fcntl.
+    """
+    def __init__(self, path, rate, capacity=None, min_rate=None):
+        if fcntl is None:
+            raise PosterousError('FileTokenBucket needs the fcntl module')
+        TokenBucket.__init__(self, rate, capacity, min_rate)
+        self.path = path
+
+    def _update(self, func):
+        self._lock.acquire()
+        try:
+            f = open(self.path, 'a+')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.seek(0)
+                state = f.read().split()
+                if len(state) == 4:
+                    self.tokens, self.updated, self.paused_until, self.rate = \
+                        [float(value) for value in state]
+                result = func(time.time())
+                f.seek(0)
+                f.truncate()
+                f.write('%r %r %r %r' % (self.tokens, self.updated,
+                                         self.paused_until, self.rate))
+                f.flush()
+                return result
+            finally:
+                # closing the file releases the lock
+                f.close()
+        finally:
+            self._lock.release()
@@ -0,0 +1,210 @@
+# Copyright:
+#    Copyright (c) 2010, Benjamin Reitzammer <http://github.com/nureineide>,
+#    All rights reserved.
+#
+# License:
+#    This program is free software. You can distribute/modify this program under
+#    the terms of the Apache License Version 2.0 available at
+#    http://www.apache.org/licenses/LICENSE-2.0.txt
+
+import base64
+import json
+import threading
+import urllib2
+from StringIO import StringIO
+
+from posterous.error import PosterousError
+from posterous.utils import enc_utf8_str
+
+
+class Transport(object):
+    """
+    Sends the HTTP requests of an API. A transport is passed to API as
+    'transport'; ConnectionPool is the default one.
+
+    urlopen() returns a response with 'status' and 'reason' attributes
+    and getheader(), read([amt]) and close() methods, like a httplib
+    response. It doesn't raise for error statuses.
+    """
+    # the number of requests the transport makes at a time
+    maxsize = 4
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """Sends the request and returns its response"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Closes the connections kept open, if there are any"""
+        pass
+
+
+class UrllibTransport(Transport):
+    """
+    Makes every request with urllib2 on a new connection. Slower than
+    ConnectionPool, but honours urllib2's proxy settings and handlers.
+    """
+    def __init__(self, timeout=None, opener=None):
+        self.timeout = timeout
+        self.opener = opener or urllib2.build_opener()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        request = urllib2.Request(url, body, headers or {})
+        request.get_method = lambda: method
+        try:
+            if self.timeout is None:
+                resp = self.opener.open(request)
+            else:
+                resp = self.opener.open(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            # error statuses are handled by the caller
+            resp = e
+        return UrllibResponse(resp)
+
+
+class UrllibResponse(object):
+    """Gives a urllib2 response the interface of a httplib response."""
+    def __init__(self, resp):
+        self.status = resp.code
+        self.reason = resp.msg
+        self.msg = resp.info()
+        self._resp = resp
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._resp.read()
+        return self._resp.read(amt)
+
+    def close(self):
+        self._resp.close()
+
+
+class RecordedResponse(object):
+    """A response whose body is held in memory."""
+    def __init__(self, status, reason, headers, payload):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.payload = payload
+        self._body = StringIO(payload)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def close(self):
+        pass
+
+
+class RecordingTransport(Transport):
+    """
+    Passes the requests on to 'transport' and appends every response to
+    the file at 'path', which a ReplayTransport can answer from later.
+    The responses are read completely before they're returned.
+
+    Every line of the file is a JSON object with the request's 'method',
+    'url' and 'body' and the response's 'status', 'reason', 'headers' and
+    'payload'; the body and payload are base64 encoded.
+    """
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.maxsize = self.transport.maxsize
+        self._lock = threading.Lock()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        resp = self.transport.urlopen(method, url, body, headers)
+        try:
+            payload = resp.read()
+        finally:
+            resp.close()
+        recorded = RecordedResponse(resp.status, resp.reason,
+                                    _headers(resp), payload)
+
+        method, url, body = _request_key(method, url, body)
+        line = json.dumps({'method': method, 'url': url,
+                           'body': body and base64.b64encode(body),
+                           'status': recorded.status,
+                           'reason': recorded.reason,
+                           'headers': recorded.headers,
+                           'payload': base64.b64encode(payload)})
+        self._lock.acquire()
+        try:
+            f = open(self.path, 'ab')
+            try:
+                f.write(line + '\n')
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+        return recorded
+
+    def clear(self):
+        self.transport.clear()
+
+
+class ReplayTransport(Transport):
+    """
+    Answers requests with the responses a RecordingTransport saved to
+    'path', without any network access. A request is matched by its
+    method, url and (urlencoded) body. Responses recorded for the same
+    request are returned in order; the last one is repeated after that.
+    """
+    def __init__(self, path, maxsize=4):
+        self.path = path
+        self.maxsize = maxsize
+        self._responses = {}
+        self._lock = threading.Lock()
+        f = open(path, 'rb')
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                r = json.loads(line)
+                body = r['body'] and base64.b64decode(r['body'])
+                key = _request_key(enc_utf8_str(r['method']),
+                                   enc_utf8_str(r['url']), body)
+                headers = dict((enc_utf8_str(name), enc_utf8_str(value)) 
+                               for name, value in r['headers'].items())
+                self._responses.setdefault(key, []).append(
+                    (r['status'], enc_utf8_str(r['reason']), headers,
+                     base64.b64decode(r['payload'])))
+        finally:
+            f.close()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        key = _request_key(method, url, body)
+        self._lock.acquire()
+        try:
+            responses = self._responses.get(key)
+            if not responses:
+                raise PosterousError('No response recorded for %s %s' %
+                                     (method, url))
+            if len(responses) > 1:
+                status, reason, headers, payload = responses.pop(0)
+            else:
+                status, reason, headers, payload = responses[0]
+        finally:
+            self._lock.release()
+        return RecordedResponse(status, reason, headers, payload)
+
+
+def _request_key(method, url, body):
+    # multipart bodies differ in their random boundary, so only their
+    # method and url are compared
+    if not isinstance(body, basestring):
+        body = None
+    return (method, url, body)
+
+
+def _headers(resp):
+    msg = getattr(resp, 'msg', None)
+    if msg is None or not hasattr(msg, 'items'):
+        return {}
+    return dict((name.lower(), value) for name, value in msg.items())
@@ -8,23 +8,43 @@
 #    http://www.apache.org/licenses/LICENSE-2.0.txt 
 
 from datetime import datetime, timedelta
-import locale
-import time
 
 
+_months = dict((name, i + 1) for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+# parsed dates by their string; posts and comments often share timestamps
+_datetime_cache = {}
+_datetime_cache_size = 1024
+
 def parse_datetime(time_string):
-    # Set locale for date parsing
-    utc_offset_str = time_string[-6:].strip()
-    sign = 1
-    
-    if utc_offset_str[0] == '-':
-        sign = -1
-        utc_offset_str = utc_offset_str[1:5]
+    """
+    Parses a date like 'Sun, 03 May 2009 19:58:58 -0800', as found in 
+    the API responses, into a datetime in UTC. 
+    """
+    try:
+        return _datetime_cache[time_string]
+    except KeyError:
+        pass
 
-    utcoffset = sign * timedelta(hours=int(utc_offset_str[0:2]), 
-                                 minutes=int(utc_offset_str[2:4]))
+    try:
+        # the fixed format is split by hand, which is much faster than 
+        # strptime and doesn't depend on the locale
+        weekday, day, month, year, clock, offset = time_string.split()
+        sign = offset[0] == '-' and -1 or 1
+        utcoffset = sign * timedelta(hours=int(offset[1:3]), 
+                                     minutes=int(offset[3:5]))
+        value = datetime(int(year), _months[month], int(day), 
+                         int(clock[0:2]), int(clock[3:5]), 
+                         int(clock[6:8])) - utcoffset
+    except (ValueError, KeyError, IndexError):
+        raise ValueError('Invalid date: %r' % time_string)
 
-    return datetime.strptime(time_string[:-6], '%a, %d %b %Y %H:%M:%S') - utcoffset
+    if len(_datetime_cache) >= _datetime_cache_size:
+        _datetime_cache.clear()
+    _datetime_cache[time_string] = value
+    return value
 
 def strip_dict(d):
     """Returns a new dictionary with keys that had a value"""
@@ -47,8 +67,22 @@ def import_simplejson():
         import simplejson as json
     except ImportError:
         try:
-            # they may have django
-            from django.utils import simplejson as json
+            # python 2.6+
+            import json
         except ImportError:
-            raise ImportError, "Can't load a json library"
+            try:
+                # they may have django
+                from django.utils import simplejson as json
+            except ImportError:
+                raise ImportError, "Can't load a json library"
     return json
+
+def import_json_decoder():
+    """Returns the fastest available function decoding a JSON string"""
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        pass
+    # simplejson's C speedups are faster than the json module of python 2
+    return import_simplejson().loads
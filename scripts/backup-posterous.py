@@ -6,13 +6,19 @@ from __future__ import with_statement
 from optparse import OptionParser
 import logging 
 import datetime
+import hashlib
 import os, os.path
+import Queue
 import re
+import sqlite3
 import sys
-import urlparse, urllib
+import threading
+import time
+import urlparse
 import simplejson
 
-from posterous.api import Posterous
+from posterous.api import API
+from posterous.models import Model
 
 
 class JsonDateEncoder(simplejson.JSONEncoder):
@@ -22,9 +28,247 @@ class JsonDateEncoder(simplejson.JSONEncoder):
                 return str(o).encode('utf8')
         except TypeError:
             pass
+        if isinstance(o, Model):
+            return dict((k, v) for k, v in vars(o).items() 
+                        if not k.startswith('_'))
         return simplejson.JSONEncoder.default(self, o)
 
 
+class Stage(object):
+    """
+    A pool of worker threads consuming a bounded queue. Every item put on
+    the queue is passed to 'func', which may return the number of bytes it 
+    handled. Keeps count of the processed items for throughput reporting
+    and remembers the items that failed in 'failures'.
+    """
+    def __init__(self, name, func, workers=1, maxsize=100):
+        self.name = name
+        self.func = func
+        self.queue = Queue.Queue(maxsize)
+        self.processed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.failures = []
+        self.started = self.finished = None
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work) 
+                         for i in range(workers)]
+
+    def start(self):
+        self.started = time.time()
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def put(self, *item):
+        # blocks while the queue is full, which throttles earlier stages
+        self.queue.put(item)
+
+    def join(self):
+        """Waits until all queued items have been processed."""
+        # workers may still queue new items, so wait for the queue to drain
+        # before telling them to stop
+        self.queue.join()
+        for t in self._threads:
+            self.queue.put(None)
+        for t in self._threads:
+            t.join()
+        self.finished = time.time()
+
+    def report(self):
+        elapsed = max((self.finished or time.time()) - self.started, 0.001)
+        line = '%-6s %6d done, %4d failed in %7.2fs (%.1f/s' % \
+               (self.name, self.processed, self.failed, elapsed, 
+                self.processed / elapsed)
+        if self.bytes:
+            line += ', %.1f KB/s' % (self.bytes / elapsed / 1024)
+        return line + ')'
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                size = self.func(*item)
+            except Exception:
+                logging.exception("%s failed for %r" % (self.name, item))
+                self._count(failed=1, item=item)
+            else:
+                self._count(processed=1, bytes=size or 0)
+            self.queue.task_done()
+
+    def _count(self, processed=0, failed=0, bytes=0, item=None):
+        self._lock.acquire()
+        try:
+            self.processed += processed
+            self.failed += failed
+            self.bytes += bytes
+            if item is not None:
+                self.failures.append(item)
+        finally:
+            self._lock.release()
+
+
+class Manifest(object):
+    """
+    Remembers the posts and media saved by earlier runs in a SQLite
+    database inside the backup folder, so unchanged posts and media
+    don't have to be written or downloaded again. A site is marked as
+    complete once all its pages, posts and media have been saved.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                site_id INTEGER, post_id INTEGER, date TEXT, hash TEXT, 
+                file TEXT, PRIMARY KEY (site_id, post_id));
+            CREATE TABLE IF NOT EXISTS media (
+                url TEXT PRIMARY KEY, file TEXT, size INTEGER);
+            CREATE TABLE IF NOT EXISTS sites (
+                site_id INTEGER PRIMARY KEY, complete INTEGER);
+        """)
+
+    def is_complete(self, site_id):
+        row = self._fetch('SELECT complete FROM sites WHERE site_id = ?', 
+                          site_id)
+        return bool(row and row[0])
+
+    def set_complete(self, site_id, complete):
+        self._execute('INSERT OR REPLACE INTO sites VALUES (?, ?)', 
+                      site_id, int(complete))
+        # must survive an interruption, so it's committed right away
+        self.lock.acquire()
+        try:
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def post_hash(self, site_id, post_id):
+        row = self._fetch('SELECT hash FROM posts ' \
+                          'WHERE site_id = ? AND post_id = ?', site_id, post_id)
+        return row and row[0]
+
+    def add_post(self, site_id, post_id, date, hash, file):
+        self._execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)', 
+                      site_id, post_id, date, hash, file)
+
+    def media(self, url):
+        """Returns a tuple of the file and size the url was saved as."""
+        return self._fetch('SELECT file, size FROM media WHERE url = ?', url)
+
+    def add_media(self, url, file, size):
+        self._execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?)', 
+                      url, file, size)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _fetch(self, sql, *params):
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, params).fetchone()
+        finally:
+            self.lock.release()
+
+    def _execute(self, sql, *params):
+        self.lock.acquire()
+        try:
+            self.db.execute(sql, params)
+            # commit regularly, so an interrupted backup can be resumed
+            self.pending += 1
+            if self.pending >= 50:
+                self.db.commit()
+                self.pending = 0
+        finally:
+            self.lock.release()
+
+
+def post_hash(p):
+    """Hashes the post's content, leaving out the ever-changing view count"""
+    data = dict((k, v) for k, v in vars(p).items() 
+                if k != 'views' and not k.startswith('_'))
+    data = simplejson.dumps(data, cls=JsonDateEncoder, sort_keys=True)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.md5(data).hexdigest()
+
+
+def fetch_page(site, site_folder, page, incremental):
+    logging.info("Retrieving page %s of site '%s' with %s posts per page" % 
+                 (page, site.hostname, options.batch_size))
+    posts = api.read_posts(site_id=site.id, page=page, 
+                           num_posts=options.batch_size)
+    changed = False
+    for p in posts:
+        h = post_hash(p)
+        if options.full or manifest.post_hash(site.id, p.id) != h:
+            changed = True
+            writer.put(site, site_folder, p, h)
+        elif not incremental:
+            # media that failed in an earlier run are downloaded again
+            queue_media(site, site_folder, p)
+
+    # Posts are returned newest first. Once a page holds nothing new, 
+    # the following pages have been backed up by an earlier run, which 
+    # completed the site (see Manifest.is_complete).
+    if incremental and changed and len(posts) == options.batch_size:
+        pages.put(site, site_folder, page + 1, incremental)
+
+
+def post_paths(site_folder, p):
+    """Returns the slug of the post and the folder it's saved in."""
+    post_slug = re.sub(r'^/', '', urlparse.urlparse(p.link).path)
+    folder = site_folder
+    if getattr(p, 'private', False):
+        folder = os.path.join(site_folder, 'private')
+    return post_slug, folder
+
+
+def write_post(site, site_folder, p, hash):
+    post_slug, folder = post_paths(site_folder, p)
+    post_file = os.path.join(folder, '%s.json' % post_slug)
+
+    logging.debug(u"Opening file '%s' for post '%s'" % (post_file, p.title))
+
+    data = simplejson.dumps(p, cls=JsonDateEncoder)
+    with open(post_file, 'w+') as f:
+        f.write(data)
+    manifest.add_post(site.id, p.id, str(getattr(p, 'date', '')), hash, 
+                      post_file)
+    queue_media(site, site_folder, p)
+    return len(data)
+
+
+def queue_media(site, site_folder, p):
+    """Puts the media of the post on the media stage."""
+    post_slug, folder = post_paths(site_folder, p)
+    for i, m in enumerate(getattr(p, 'media', [])):
+        u = m.url
+        media_type = re.search(r'\.(\w+)$', u).group(1)
+        media_file = os.path.join(folder, '%s_%s.%s' % 
+                                  (post_slug, i, media_type))                
+        media.put(site, u, media_file)
+
+
+def download_media(site, url, media_file):
+    saved = manifest.media(url)
+    if not options.full and saved and saved[0] == media_file and \
+       os.path.exists(media_file) and os.path.getsize(media_file) == saved[1]:
+        logging.debug("Skipping media from url '%s'" % url)
+        return 0
+
+    logging.debug("Getting media from url '%s'" % url)
+    # streamed in chunks; an interrupted download is resumed by the next run
+    size, digest = api.downloader.download(url, media_file)
+    manifest.add_media(url, media_file, size)
+    return size
+
+
 if __name__ == '__main__':
     """
         Create a folder structure where 
@@ -33,9 +277,19 @@ if __name__ == '__main__':
                 site-{site.hostname}.json
                 {post-slug}.json  <-- contains body & comments & everything else
                 {post-slug}_media{num}
+                /private
+                    {post-slug}.json <-- same for private posts
+            manifest.db  <-- posts and media saved by earlier runs
+
+        Pages, post files and media are handled by separate pools of 
+        worker threads connected through bounded queues. Unless --full
+        is given, paging of a site that was backed up completely before
+        stops at the first page without new or changed posts, and media
+        already in the manifest isn't downloaded again.
     """
     
     batch_sz = 50 # default (and current api max)
+    workers = 4
     opt_parser = OptionParser()
     
     opt_parser.add_option("-u", "--username", dest="username", 
@@ -48,6 +302,10 @@ if __name__ == '__main__':
         help="Folder to store backup data in (Beware, if it exists, " \
              "data may be overwritten). Defaults to backup/")
     
+    opt_parser.add_option("--host", dest="host", 
+        default="https://posterous.com", help="The host of the API. " \
+                                              "Default is https://posterous.com")
+    
     opt_parser.add_option("-s", "--site-id", type="int", dest="site_id",                
         help="Only query site with this id")
     
@@ -55,6 +313,18 @@ if __name__ == '__main__':
         default=batch_sz, help="The number of posts to get per API call. " \
                                "Default is %d" % batch_sz)
     
+    opt_parser.add_option("-w", "--workers", type="int", dest="workers", 
+        default=workers, help="The number of concurrent page and media " \
+                              "downloads. Default is %d" % workers)
+    
+    opt_parser.add_option("--segments", type="int", dest="segments", 
+        default=1, help="Download media files larger than 8 MB with this " \
+                        "many parallel ranged requests. Default is 1")
+    
+    opt_parser.add_option("--full", dest="full", action="store_true", 
+        default=False, help="Back up all posts and media, even if the " \
+                            "manifest lists them as unchanged")
+    
     opt_parser.add_option("-d", "--debug", dest="debug", action="store_true", 
         default=False, help="Debug output")
     
@@ -80,9 +350,23 @@ if __name__ == '__main__':
         sys.exit()
 
     # Make the API calls and parse the data
-    posterous = Posterous(options.username, options.password)
+    api = API(options.username, options.password, host=options.host,
+              max_connections=options.workers * options.segments)
+    api.downloader.segments = options.segments
+
+    if not os.path.exists(options.folder):
+        os.makedirs(options.folder)
+    manifest = Manifest(os.path.join(options.folder, 'manifest.db'))
+
+    # not bounded, since the workers queue the next page themselves
+    pages = Stage('pages', fetch_page, options.workers, maxsize=0)
+    writer = Stage('posts', write_post)
+    media = Stage('media', download_media, options.workers, maxsize=1000)
+    for stage in (pages, writer, media):
+        stage.start()
 
-    for site in posterous.get_sites():
+    sites = []
+    for site in api.get_sites():
         if options.site_id and options.site_id != site.id:
             continue
 
@@ -103,31 +387,33 @@ if __name__ == '__main__':
         with open(site_file, 'w+') as sf:
             simplejson.dump(site, sf, cls=JsonDateEncoder)
             
-        rem = 2 if site.num_posts % options.batch_size > 0 else 1
-        page_numbers = range(1, int(site.num_posts/options.batch_size) + rem)
+        # only complete once this run saved everything
+        complete = manifest.is_complete(site.id)
+        manifest.set_complete(site.id, False)
+        sites.append(site)
 
-        for page in page_numbers:
-            logging.info("Retrieving page %s of %s with %s posts per page" % 
-                         (page, len(page_numbers), options.batch_size))
-            
-            for p in posterous.get_posts(site_id=site.id, page_num=page, 
-                                         num_posts=options.batch_size):
-                post_slug = re.sub(r'^/', '', urlparse.urlparse(p.link).path)
-                post_file = os.path.join(site_folder, '%s.json' % post_slug)
-            
-                logging.debug(u"Opening file '%s' for post '%s'" % 
-                              (post_file, p.title))
-
-                with open(post_file, 'w+') as f:
-                    simplejson.dump(p, f, cls=JsonDateEncoder)
-                
-                # save the media from each post
-                for i, m in enumerate(p.media):
-                    u = m.medium_url if hasattr(m, 'medium_url') else m.url
-                    media_type = re.search(r'\.(\w+)$', u).group(1)
-                    media_file = os.path.join(site_folder, '%s_%s.%s' % 
-                                              (post_slug, i, media_type))                
-                    logging.debug("Getting media for post '%s' from url '%s'" %
-                                  (p.title, u))
-                
-                    urllib.urlretrieve(u, media_file)
+        if options.full or not complete:
+            # an earlier run may have missed any page, so fetch all pages 
+            # concurrently
+            rem = 2 if site.num_posts % options.batch_size > 0 else 1
+            page_numbers = range(1, int(site.num_posts/options.batch_size) + rem)
+
+            for page in page_numbers:
+                pages.put(site, site_folder, page, False)
+        else:
+            pages.put(site, site_folder, 1, True)
+
+    # every stage only gets new items from the one before it
+    for stage in (pages, writer, media):
+        stage.join()
+
+    failed = set(item[0].id for stage in (pages, writer, media) 
+                 for item in stage.failures)
+    for site in sites:
+        if site.id not in failed:
+            manifest.set_complete(site.id, True)
+
+    for stage in (pages, writer, media):
+        print stage.report()
+
+    manifest.close()
@@ -0,0 +1,133 @@
+"""
+    needs python 2.6
+
+    Imports posts into Posterous from a JSON lines file, one post per line:
+
+    {"key": "hello-world", "title": "Hello", "body": "...", "date": 
+     "2009-05-03T19:58:58", "tags": "a,b", "media": ["img/1.jpg"]}
+
+    Every item apart from 'key' is passed to API.new_post. 'key' identifies
+    the post in the checkpoint file; without it, the line number is used.
+    Media may be given as file names, relative to the input file, or as 
+    urls. Posts listed in the checkpoint file are skipped, so running the
+    same import again resumes it.
+"""
+
+from optparse import OptionParser
+import logging
+import os, os.path
+import sys
+import time
+import simplejson
+
+from posterous.api import API
+from posterous.importer import PostImporter
+
+
+def read_posts(path, site_id, invalid):
+    """
+    Yields the posts in the file. Lines that aren't a JSON object, or
+    whose media aren't file names or urls, are reported and added to
+    'invalid' as failed results, keyed by their line number.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    f = open(path)
+    try:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                post = simplejson.loads(line)
+                if not isinstance(post, dict):
+                    raise ValueError('Not a JSON object')
+                # keyword arguments can't be unicode in python 2.6
+                post = dict((str(k), v) for k, v in post.items())
+                media = post.get('media')
+                if media:
+                    if not isinstance(media, list):
+                        media = [media]
+                    for m in media:
+                        if not isinstance(m, basestring):
+                            raise ValueError('Media must be file names or '
+                                             'urls, not %r' % (m,))
+                    post['media'] = [m.split(':', 1)[0] in ('http', 'https') 
+                                     and m or os.path.join(folder, m) 
+                                     for m in media]
+            except ValueError, e:
+                error = ValueError('Line %d: %s' % (i + 1, e))
+                report(str(i + 1), None, error)
+                invalid.append((str(i + 1), None, error))
+                continue
+            post.setdefault('key', i + 1)
+            if site_id:
+                post.setdefault('site_id', site_id)
+            yield post
+    finally:
+        f.close()
+
+
+def report(key, post, error):
+    if error is None:
+        logging.info("Imported post %s as %s" % (key, getattr(post, 'url', 
+                                                              post.id)))
+    else:
+        logging.error("Failed to import post %s: %s" % (key, error))
+
+
+if __name__ == '__main__':
+    workers = 4
+    opt_parser = OptionParser(usage="%prog [options] posts.jsonl")
+
+    opt_parser.add_option("-u", "--username", dest="username", 
+        help="Email address associated with posterous account")
+    
+    opt_parser.add_option("-p", "--password", dest="password", 
+        help="Password associated with posterous account")
+    
+    opt_parser.add_option("-s", "--site-id", type="int", dest="site_id",
+        help="Site to import posts without a site_id into. Defaults to " \
+             "the primary site")
+    
+    opt_parser.add_option("-w", "--workers", type="int", dest="workers", 
+        default=workers, help="The number of posts uploaded at a time. " \
+                              "Default is %d" % workers)
+    
+    opt_parser.add_option("-r", "--rate", type="float", dest="rate", 
+        default=None, help="The maximum number of posts created per second")
+    
+    opt_parser.add_option("-c", "--checkpoint", dest="checkpoint", 
+        help="File recording the imported posts. Defaults to the input " \
+             "file name with .checkpoint appended")
+    
+    opt_parser.add_option("-v", "--verbose", dest="verbose", 
+        action="store_true", default=False, help="Verbose output")
+    
+    (options, args) = opt_parser.parse_args()
+    
+    logging.basicConfig(level=options.verbose and logging.INFO or 
+                              logging.WARNING)
+    
+    if len(args) != 1 or not options.username or not options.password:
+        print "You must provide a username, password and input file.\n"
+        opt_parser.print_help()
+        sys.exit(2)
+
+    api = API(options.username, options.password, 
+              max_connections=options.workers)
+    importer = PostImporter(api, options.workers, options.rate, 
+                            options.checkpoint or args[0] + '.checkpoint')
+
+    started = time.time()
+    invalid = []
+    results = importer.run(read_posts(args[0], options.site_id, invalid), 
+                           report)
+    results += invalid
+
+    failed = [key for key, post, error in results if error is not None]
+    imported = [key for key, post, error in results if post is not None]
+    print "%d imported, %d skipped, %d failed in %.1fs" % \
+          (len(imported), len(results) - len(imported) - len(failed), 
+           len(failed), time.time() - started)
+    if failed:
+        print "Failed posts: %s" % ', '.join(failed)
+        sys.exit(1)
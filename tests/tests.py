@@ -3,17 +3,317 @@ import sys
 sys.path.append("..")
 
 from datetime import datetime 
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import base64
+import cgi
+import cPickle as pickle
+import hashlib
+import httplib
+import imp
+import io
+import json
 import os.path
+import shutil
+import socket
+import sqlite3
+import StringIO
+import subprocess
+import tempfile
+import threading
+import time
+import urlparse
+import xml.etree.cElementTree as ET
+from optparse import Values
 from posterous.api import *
+from posterous.executor import Executor
+from posterous.error import PosterousError, HTTPError, RateLimitError, \
+                            TransportError
+from posterous.models import ModelFactory, CompactModelFactory, Post, Media
+from posterous.download import Downloader
+from posterous.multipart import File
+from posterous.pool import ConnectionPool
+from posterous.importer import PostImporter
+from posterous.ratelimit import TokenBucket, FileTokenBucket
+from posterous.parsers import ModelParser, DirectModelParser, LazyModelParser, \
+                              XMLDict, casters, register_type, set_type
+from posterous.cursor import Cursor
+from posterous.metrics import MetricsCollector, StatsdMetrics
+from posterous.mockserver import MockServer, ERROR
+from posterous.transport import UrllibTransport, RecordingTransport, \
+                                ReplayTransport
+from posterous.cache import MemoryCache, FileCache
+from posterous.utils import parse_datetime
 
 
 def get_file_name(n):
     return os.path.join(os.path.dirname( os.path.realpath( __file__ ) ), n)
 
 
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves the XML fixtures over keep-alive HTTP/1.1"""
+    protocol_version = 'HTTP/1.1'
+    fixtures = {'/api/getsites': 'sites.xml'}
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        self.server.requests.append(self.path)
+        with open(get_file_name(self.fixtures[self.path.split('?')[0]])) as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PostsHandler(FixtureHandler):
+    """Generates readposts pages for a site with 'num_posts' posts"""
+    num_posts = 23
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path == '/api/getpost':
+            return self.getpost(dict(urlparse.parse_qsl(query)))
+        if path != '/api/readposts':
+            return FixtureHandler.do_GET(self)
+        self.server.requests.append(self.path)
+        params = dict(urlparse.parse_qsl(query))
+        per_page = int(params.get('num_posts', 10))
+        first = (int(params.get('page', 1)) - 1) * per_page
+        ids = range(first + 1, min(first + per_page, self.num_posts) + 1)
+        body = posts_xml(ids)
+        if self.headers.getheader('Accept') == 'application/json':
+            body = json.dumps([element_json(post) for post in ET.XML(body)])
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def getpost(self, params):
+        self.server.requests.append(self.path)
+        if params['id'].isdigit():
+            body = posts_xml([int(params['id'])])
+        else:
+            body = '<rsp stat="fail"><err code="3001" msg="Invalid post" /></rsp>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path == '/api/upload':
+            return self.upload()
+        self.server.requests.append(self.path)
+        data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.posted.append((self.headers.getheader('Content-Type'), data))
+        body = posts_xml([self.num_posts + 1])
+        if 'FAIL' in data:
+            body = '<rsp stat="fail"><err code="3002" msg="Failed" /></rsp>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def upload(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        body = json.dumps({'id': 24, 'url': 'http://post.ly/24'})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FilesHandler(FixtureHandler):
+    """
+    Serves /files/<size>, supporting HEAD and Range requests, and 
+    redirects /redirect/<path> to /<path>. HEAD requests are answered 
+    with 'server.head_status' if it's set.
+    """
+
+    def do_HEAD(self):
+        status = getattr(self.server, 'head_status', None)
+        if status:
+            self.server.requests.append(('HEAD', self.path, None))
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        self.server.requests.append((self.command, self.path, 
+                                     self.headers.getheader('Range')))
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not self.path.startswith('/files/'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = file_data(int(self.path.split('/')[-1].split('.')[0]))
+        start, end = 0, len(body) - 1
+        range = self.headers.getheader('Range')
+        if range:
+            first, _, last = range[len('bytes='):].partition('-')
+            start, end = int(first), int(last or end)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % 
+                             (start, end, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body[start:end + 1])
+
+
+class StallingHandler(PostsHandler):
+    """Sends half of a readposts page, then stalls for a second"""
+
+    def do_GET(self):
+        body = posts_xml(range(1, 11))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.wfile.flush()
+        time.sleep(1)
+
+
+class ThrottlingHandler(PostsHandler):
+    """Answers the first 'server.throttle' requests with 429 or 'status'"""
+
+    def do_GET(self):
+        if self.server.throttle > 0:
+            self.server.throttle -= 1
+            self.server.requests.append(self.path)
+            self.send_response(self.server.status)
+            if self.server.retry_after is not None:
+                self.send_header('Retry-After', self.server.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        PostsHandler.do_GET(self)
+
+
+class DroppingHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request, then closes the connection without telling
+    the client if 'server.drop' is set, like a server dropping idle 
+    keep-alive connections. Requests to /slow are answered after 
+    'server.delay' seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+        if self.path == '/slow':
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+        self.close_connection = int(self.server.drop)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length')))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def file_data(size):
+    return ''.join(chr(i % 251) for i in xrange(size))
+
+
+def element_json(element):
+    """Returns the JSON counterpart of an XML element"""
+    if not len(element):
+        return (element.text or '').strip()
+    data = {}
+    for child in element:
+        value = element_json(child)
+        if child.tag not in data:
+            data[child.tag] = value
+        elif isinstance(data[child.tag], list):
+            data[child.tag].append(value)
+        else:
+            data[child.tag] = [data[child.tag], value]
+    return data
+
+
+def model_state(value):
+    """Returns the attributes of models (and nested models) as dicts"""
+    if isinstance(value, list):
+        return [model_state(v) for v in value]
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return dict((k, model_state(v)) for k, v in vars(value).items()
+                    if not k.startswith('_'))
+    return value
+
+
+def posts_xml(ids):
+    posts = ''.join('<post><id>%d</id><title>Post %d</title>'
+                    '<link>http://sachin.posterous.com/post-%d</link>'
+                    '<date>Sun, 03 May 2009 19:58:58 -0800</date></post>'
+                    % (i, i, i) for i in ids)
+    return '<rsp stat="ok">%s</rsp>' % posts
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(handler=FixtureHandler):
+    """Starts a local stand-in for posterous.com and returns it"""
+    server = FixtureServer(('127.0.0.1', 0), handler)
+    server.clients = set()
+    server.requests = []
+    server.posted = []
+    server.url = 'http://127.0.0.1:%s' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class PostsMethod(object):
+    payload_type = 'post'
+    payload_list = True
+    response_type = 'xml'
+    api = None
+    fields = None
+
+
+class SitesMethod(PostsMethod):
+    payload_type = 'site'
+
+
 def test_sites_xml_parser():
     with open(get_file_name('sites.xml')) as f:
-        sites = posterous.parse_sites_xml(f.read())
+        sites = ModelParser().parse(SitesMethod, f.read())
         
         assert len(sites) == 2
         assert sites[0].name == "Sachin Agarwal's Posterous"
@@ -28,7 +328,7 @@ def test_sites_xml_parser():
         
 def test_post_xml_parser():
     with open(get_file_name('posts.xml')) as f:
-        posts = posterous.parse_posts_xml(f.read())
+        posts = ModelParser().parse(PostsMethod, f.read())
         
         assert len(posts) == 4, "List length is %s" % len(posts)
         p = posts[0]
@@ -41,26 +341,26 @@ def test_post_xml_parser():
         assert p.commentsenabled == True
         assert p.link == 'http://sachin.posterous.com/brunch-in-san-francisco'
         assert p.authorpic == 'http://debug2.posterous.com/user_profile_pics/16071/Picture_1_thumb.png'
-        assert p.date == posterous.parse_date('Sun, 03 May 2009 19:58:58 -0800')
+        assert p.date == parse_datetime('Sun, 03 May 2009 19:58:58 -0800')
         
         assert len(p.comments) == 1
         assert p.comments[0].body == 'This is a comment'
         assert p.comments[0].author == 'sachin'
-        assert p.comments[0].date == posterous.parse_date('Thu, 04 Jun 2009 01:33:43 -0800')
+        assert p.comments[0].date == parse_datetime('Thu, 04 Jun 2009 01:33:43 -0800')
         
         assert len(p.media) == 3
         img = p.media[0]
         aud = p.media[1]
         vid = p.media[2]
         
-        assert img.medium_filesize == 47
-        assert img.medium_url == 'http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/IMG_0477.scaled500.jpg'
-        assert img.medium_width == 500
-        assert img.medium_height == 333
-        assert img.thumb_url == 'http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/IMG_0477.thumb.jpg'
-        assert img.thumb_filesize == 5
-        assert img.thumb_height == 36
-        assert img.thumb_width == 36
+        assert img.filesize == 47
+        assert img.url == 'http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/IMG_0477.scaled500.jpg'
+        assert img.width == 500
+        assert img.height == 333
+        assert img.thumb.url == 'http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/IMG_0477.thumb.jpg'
+        assert img.thumb.filesize == 5
+        assert img.thumb.height == 36
+        assert img.thumb.width == 36
         
         assert aud.url == "http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/sheila.mp3"
         assert aud.filesize == 10116
@@ -73,5 +373,1167 @@ def test_post_xml_parser():
         assert vid.thumb == "http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/movie.png"
         assert vid.flv == "http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/movie.flv"
         assert vid.mp4 == "http://posterous.com/getfile/files.posterous.com/sachin/DIptatiCkiv/movie.mp4"
-        
-    
+
+
+def test_connection_pool_reuse():
+    server = start_server()
+    try:
+        api = API('user', 'pass', host=server.url)
+        for i in range(3):
+            sites = api.get_sites()
+            assert len(sites) == 2
+        assert len(server.requests) == 3
+        assert len(server.clients) == 1, server.clients
+    finally:
+        server.shutdown()
+
+
+def test_connection_pool_idle_timeout():
+    server = start_server()
+    try:
+        api = API('user', 'pass', host=server.url, idle_timeout=0)
+        api.get_sites()
+        api.get_sites()
+        assert len(server.clients) == 2, server.clients
+    finally:
+        server.shutdown()
+
+
+def test_connection_pool_retries_dropped_connections():
+    server = start_server(DroppingHandler)
+    server.drop, server.delay = True, 1
+    try:
+        pool = ConnectionPool(timeout=0.5)
+        for i in range(3):
+            # the connection the server dropped is detected when it's 
+            # reused, and the request is sent again on a new one
+            resp = pool.urlopen('GET', server.url + '/')
+            assert resp.read() == 'ok'
+            time.sleep(0.1)
+        assert len(server.requests) == 3, server.requests
+
+        # a POST the server may have received isn't sent again
+        pool.clear()
+        resp = pool.urlopen('POST', server.url + '/', 'a=1')
+        assert resp.read() == 'ok'
+        time.sleep(0.1)
+        del server.requests[:]
+        try:
+            pool.urlopen('POST', server.url + '/', 'a=2')
+            assert False, 'expected an error'
+        except (httplib.HTTPException, socket.error):
+            pass
+        assert server.requests == []
+
+        # neither is a request that timed out on a reused connection
+        server.drop = False
+        resp = pool.urlopen('GET', server.url + '/')
+        assert resp.read() == 'ok'
+        del server.requests[:]
+        try:
+            pool.urlopen('GET', server.url + '/slow')
+            assert False, 'expected a timeout'
+        except socket.timeout:
+            pass
+        assert len(server.requests) == 1, server.requests
+    finally:
+        server.shutdown()
+
+
+def test_stream_sites():
+    server = start_server()
+    try:
+        api = API('user', 'pass', host=server.url)
+        sites = api.get_sites(stream=True)
+        assert not isinstance(sites, list)
+        sites = list(sites)
+        assert [s.hostname for s in sites] == ['sachin', 'agarwal']
+        assert sites[1].num_posts == 40
+        # the connection went back to the pool after streaming
+        api.get_sites()
+        assert len(server.clients) == 1, server.clients
+    finally:
+        server.shutdown()
+
+
+def test_stream_read_errors():
+    server = start_server(StallingHandler)
+    try:
+        api = API('user', 'pass', host=server.url, timeout=0.2)
+        for stream in (False, True):
+            try:
+                list(api.read_posts(site_id=1, stream=stream))
+                assert False, 'expected an error'
+            except TransportError, e:
+                assert 'timed out' in str(e)
+    finally:
+        server.shutdown()
+
+
+def test_discarded_stream_releases_connection():
+    server = MockServer(num_posts=25).start()
+    try:
+        api = API('user', 'pass', host=server.url, max_connections=1)
+        result = []
+
+        def calls():
+            # never started, then thrown away
+            api.read_posts(site_id=1, stream=True)
+            posts = api.read_posts(site_id=1, stream=True)
+            assert posts.next().id == 1
+            posts.close()
+            result.append(api.read_posts(site_id=1))
+
+        # blocks forever if the only connection slot leaked
+        t = threading.Thread(target=calls)
+        t.daemon = True
+        t.start()
+        t.join(5)
+        assert len(result) == 1 and len(result[0]) == 10
+    finally:
+        server.stop()
+
+
+def test_stream_yields_before_end_of_response():
+    class ChunkedFile(object):
+        def __init__(self, data):
+            self.chunks = [data[i:i + 64] for i in range(0, len(data), 64)]
+            self.consumed = 0
+
+        def read(self, size=-1):
+            if self.consumed == len(self.chunks):
+                return ''
+            self.consumed += 1
+            return self.chunks[self.consumed - 1]
+
+    class Method(object):
+        payload_type = 'site'
+        payload_list = True
+        response_type = 'xml'
+        api = None
+
+    with open(get_file_name('sites.xml')) as f:
+        stream = ChunkedFile(f.read())
+
+    from posterous.parsers import ModelParser
+    sites = ModelParser().parse_stream(Method, stream)
+    assert sites.next().id == 1
+    assert stream.consumed < len(stream.chunks)
+    assert sites.next().id == 2
+
+
+def test_cursor_pages():
+    server = start_server(PostsHandler)
+    try:
+        api = API(host=server.url)
+        pages = list(Cursor(api.read_posts, site_id=1, num_posts=10).pages())
+        assert [len(p) for p in pages] == [10, 10, 3]
+        assert len(server.requests) == 3
+
+        posts = list(api.iter_posts(site_id=1, num_posts=5, prefetch=True))
+        assert [p.id for p in posts] == range(1, 24)
+
+        posts = Cursor(api.read_posts, site_id=1, num_posts=5).items(limit=7)
+        assert len(list(posts)) == 7
+    finally:
+        server.shutdown()
+
+
+def test_cursor_stops_on_full_last_page():
+    server = start_server(PostsHandler)
+    try:
+        api = API(host=server.url)
+        pages = list(Cursor(api.read_posts, site_id=1, num_posts=23).pages())
+        assert [len(p) for p in pages] == [23]
+        assert len(server.requests) == 2
+    finally:
+        server.shutdown()
+
+
+def test_memory_cache():
+    cache = MemoryCache(timeout=60, maxsize=2)
+    cache.store('a', 1)
+    cache.store('b', 2)
+    assert cache.get('a') == 1
+    cache.store('c', 3)
+    # 'b' was the least recently used value
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    cache.store('d', 4, timeout=0.01)
+    time.sleep(0.02)
+    assert cache.get('d') is None
+
+    cache.invalidate('a')
+    assert cache.count() == 1
+
+    # storing a value again makes it the most recently used one
+    cache.store('e', 5)
+    cache.store('c', 6)
+    cache.store('f', 7)
+    assert cache.get('e') is None
+    assert cache.get('c') == 6 and cache.get('f') == 7
+
+    cache.flush()
+    assert cache.count() == 0 and cache.get('c') is None
+    cache.store('g', 8)
+    assert cache.get('g') == 8 and cache.count() == 1
+
+
+def test_api_cache():
+    server = start_server(PostsHandler)
+    try:
+        api = API('user', 'pass', host=server.url, cache=MemoryCache())
+        sites = api.get_sites()
+        assert api.get_sites() is sites
+        api.read_posts(site_id=1)
+        api.read_posts(site_id=1)
+        api.read_posts(site_id=2)
+        assert len(server.requests) == 3
+
+        # other users don't share the cached results
+        API('other', 'pass', host=server.url, cache=api.cache).get_sites()
+        assert len(server.requests) == 4
+
+        api.cache.invalidate('readposts?')
+        api.read_posts(site_id=1)
+        assert len(server.requests) == 5
+        assert api.get_sites() is sites
+
+        post = api.new_post(site_id=1, title='New')
+        assert post.id == 24
+        api.read_posts(site_id=1)
+        api.get_sites()
+        assert len(server.requests) == 8
+    finally:
+        server.shutdown()
+
+
+def test_file_cache():
+    server = start_server()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        api = API('user', 'pass', host=server.url, 
+                  cache=FileCache(cache_dir))
+        api.get_sites()
+        sites = API('user', 'pass', host=server.url, 
+                    cache=FileCache(cache_dir)).get_sites()
+        assert len(server.requests) == 1
+        assert sites[0].hostname == 'sachin'
+        assert sites[0]._api is not None
+        api.cache.invalidate('getsites?')
+        assert api.cache.count() == 0
+    finally:
+        shutil.rmtree(cache_dir)
+        server.shutdown()
+
+
+class LoadCounter(object):
+    """A cached value which counts how often it's unpickled"""
+    loads = 0
+
+    def __setstate__(self, state):
+        LoadCounter.loads += 1
+
+
+def test_file_cache_invalidate():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = FileCache(cache_dir)
+        keys = ['readposts?site_id=1#user', 'readposts?site_id=2#user',
+                'getsites?#user', 'getpost?id=1#user', 'gettags?#user']
+        for key in keys:
+            cache.store(key, LoadCounter())
+        LoadCounter.loads = 0
+        cache.invalidate('readposts?site_id=1')
+        cache.invalidate('getsites?')
+        cache.invalidate('gett')
+        # found by their file names, without loading the values
+        assert LoadCounter.loads == 0
+        assert [cache.get(key) is not None for key in keys] == \
+               [False, True, False, True, False]
+        assert LoadCounter.loads == 2
+        assert cache.count() == 2
+        cache.flush()
+        assert cache.count() == 0
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_conditional_requests():
+    server = start_server()
+    try:
+        api = API('user', 'pass', host=server.url, conditional_requests=True)
+        sites = api.get_sites()
+        assert api.get_sites() is sites
+        assert len(server.requests) == 2
+        # the 304 left the connection usable
+        assert len(server.clients) == 1
+
+        sites = API('user', 'pass', host=server.url).get_sites()
+        assert len(sites) == 2
+    finally:
+        server.shutdown()
+
+
+def test_executor():
+    executor = Executor(2)
+    assert executor.map(lambda x: x * 2, range(10)) == range(0, 20, 2)
+
+    future = executor.submit(int, 'x')
+    assert isinstance(future.exception(), ValueError)
+    try:
+        future.result()
+        assert False
+    except ValueError:
+        pass
+
+    called = []
+    future.add_done_callback(called.append)
+    assert called == [future]
+
+    future = executor.submit(time.sleep, 0.2)
+    for wait in (future.result, future.exception):
+        try:
+            wait(0.01)
+            assert False, 'expected a timeout'
+        except PosterousError, e:
+            assert 'Timed out' in str(e)
+    assert future.result(1) is None
+    assert len(executor._threads) <= 2
+    executor.shutdown()
+
+
+def test_async_api():
+    server = start_server(PostsHandler)
+    try:
+        api = AsyncAPI('user', 'pass', host=server.url, concurrency=3)
+        futures = [api.read_posts(site_id=1, page=page, num_posts=5)
+                   for page in range(1, 6)]
+        pages = [f.result() for f in futures]
+        assert [p.id for p in pages[0]] == range(1, 6)
+        assert [len(p) for p in pages] == [5, 5, 5, 5, 3]
+        assert len(server.clients) <= 3
+
+        assert len(list(api.iter_posts(site_id=1))) == 23
+        api.close()
+    finally:
+        server.shutdown()
+
+
+def test_get_posts_batch():
+    server = start_server(PostsHandler)
+    try:
+        api = API(host=server.url)
+        results = api.get_posts_batch(['3', 'abc', '1', '3'], max_workers=2)
+        assert [id for id, post, error in results] == ['3', 'abc', '1', '3']
+        assert results[0][1].id == 3 and results[0][2] is None
+        assert results[0][1] is results[3][1]
+        assert results[1][1] is None
+        assert isinstance(results[1][2], PosterousError)
+        assert results[2][1].id == 1
+        assert len(server.requests) == 3
+    finally:
+        server.shutdown()
+
+
+def test_compact_models():
+    server = start_server()
+    try:
+        api = API('user', 'pass', host=server.url,
+                  parser=ModelParser(CompactModelFactory))
+        sites = api.get_sites()
+        assert sites[0].hostname == 'sachin' and sites[0].num_posts == 50
+        assert not hasattr(sites[0], '__dict__')
+
+        # attributes without a slot still work
+        sites[0].extra = 'value'
+        assert sites[0].extra == 'value'
+        assert not hasattr(sites[1], 'extra')
+    finally:
+        server.shutdown()
+
+
+def test_direct_model_parser():
+    with open(get_file_name('posts.xml')) as f:
+        payload = f.read()
+    posts = DirectModelParser().parse(PostsMethod, payload)
+    expected = ModelParser().parse(PostsMethod, payload)
+
+    assert len(posts) == 4
+    for post, other in zip(posts, expected):
+        assert sorted(vars(post)) == sorted(vars(other))
+        assert post.title == other.title and post.date == other.date
+        assert len(getattr(post, 'comments', [])) == \
+               len(getattr(other, 'comments', []))
+
+    img, aud, vid = posts[0].media
+    assert img.url.endswith('IMG_0477.scaled500.jpg') and img.width == 500
+    assert img.thumb.url.endswith('IMG_0477.thumb.jpg')
+    assert aud.artist == 'Smashing Pumpkins' and aud.filesize == 10116
+    assert vid.thumb.endswith('movie.png')
+    assert [c.author for c in posts[1].comments] == ['Benjamin', 'test']
+
+
+def test_lazy_model_parser():
+    with open(get_file_name('posts.xml')) as f:
+        payload = f.read()
+    expected = DirectModelParser().parse(PostsMethod, payload)
+
+    for factory in (ModelFactory, CompactModelFactory):
+        posts = LazyModelParser(factory).parse(PostsMethod, payload)
+        assert len(posts) == 4
+        # only accessed attributes are built
+        assert posts[0].title == expected[0].title
+        if factory is ModelFactory:
+            assert 'title' in vars(posts[0]) and 'body' not in vars(posts[0])
+        assert not hasattr(posts[0], 'nosuchattr')
+
+        img, aud, vid = posts[0].media
+        assert img.width == 500 and img.thumb.url.endswith('.thumb.jpg')
+        assert aud.filesize == 10116 and vid.thumb.endswith('movie.png')
+        assert [c.author for c in posts[1].comments] == ['Benjamin', 'test']
+
+        # pickling builds the remaining attributes
+        copy = pickle.loads(pickle.dumps(posts[2]))
+        assert not hasattr(copy, '_source')
+        assert copy.date == expected[2].date and copy.body == expected[2].body
+
+
+def test_fields():
+    with open(get_file_name('posts.xml')) as f:
+        payload = f.read()
+
+    class ProjectedMethod(PostsMethod):
+        fields = frozenset(['id', 'title', 'comment', 'comments'])
+
+    for parser in (ModelParser(), DirectModelParser(), LazyModelParser()):
+        posts = parser.parse(ProjectedMethod, payload)
+        assert posts[0].id and posts[0].title
+        assert not hasattr(posts[0], 'body') and not hasattr(posts[0], 'media')
+        assert [c.author for c in posts[1].comments] == ['Benjamin', 'test']
+        # nested models are complete
+        assert posts[1].comments[0].body
+
+    server = start_server(PostsHandler)
+    try:
+        api = API(host=server.url, cache=MemoryCache())
+        posts = api.read_posts(site_id=1, fields='id, Title')
+        assert len(posts) == 10
+        assert sorted(vars(posts[0])) == ['id', 'title']
+        # projected results are cached separately
+        assert hasattr(api.read_posts(site_id=1)[0], 'date')
+        assert len(server.requests) == 2
+        assert api.read_posts(site_id=1, fields=['title', 'id']) is posts
+    finally:
+        server.shutdown()
+
+
+def test_download():
+    server = start_server(FilesHandler)
+    folder = tempfile.mkdtemp()
+    try:
+        data = file_data(100000)
+        url = server.url + '/files/100000'
+        path = os.path.join(folder, 'video.mov')
+        downloader = Downloader(chunk_size=4096)
+        assert downloader.download(url, path) == \
+               (100000, hashlib.md5(data).hexdigest())
+        assert open(path, 'rb').read() == data
+        assert not os.path.exists(path + '.part')
+
+        # an interrupted download is resumed
+        with open(path + '.part', 'wb') as f:
+            f.write(data[:30000])
+        del server.requests[:]
+        assert downloader.download(url, path)[0] == 100000
+        assert open(path, 'rb').read() == data
+        assert server.requests == [('GET', '/files/100000', 'bytes=30000-')]
+
+        # large files are fetched in parallel segments
+        del server.requests[:]
+        downloader = Downloader(chunk_size=4096, segments=3, segment_size=1000)
+        assert downloader.download(url, path, hashlib.md5(data).hexdigest())
+        assert open(path, 'rb').read() == data
+        ranges = sorted(r for m, p, r in server.requests if m == 'GET')
+        assert ranges == ['bytes=0-33333', 'bytes=33334-66667', 
+                          'bytes=66668-99999']
+
+        try:
+            downloader.download(url, path, 'bad')
+            assert False, 'expected a checksum error'
+        except PosterousError:
+            assert not os.path.exists(path + '.part')
+        try:
+            downloader.download(server.url + '/api/nothing', path)
+            assert False, 'expected an error'
+        except PosterousError, e:
+            assert e.error_code == 404
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+
+def test_download_redirects():
+    server = start_server(FilesHandler)
+    folder = tempfile.mkdtemp()
+    try:
+        data = file_data(10000)
+        path = os.path.join(folder, 'image.jpg')
+        downloader = Downloader()
+        downloader.download(server.url + '/redirect/files/10000', path)
+        assert open(path, 'rb').read() == data
+        assert [p for m, p, r in server.requests] == \
+               ['/redirect/files/10000', '/files/10000']
+
+        # the segments are requested from the url redirected to
+        del server.requests[:]
+        downloader = Downloader(segments=2, segment_size=1000)
+        downloader.download(server.url + '/redirect/files/10000', path)
+        assert open(path, 'rb').read() == data
+        assert sorted(p for m, p, r in server.requests if r) == \
+               ['/files/10000', '/files/10000']
+
+        # no HEAD support, so the file is fetched with a single GET
+        del server.requests[:]
+        server.head_status = 405
+        downloader.download(server.url + '/files/10000', path)
+        assert open(path, 'rb').read() == data
+        assert [(m, r) for m, p, r in server.requests] == \
+               [('HEAD', None), ('GET', None)]
+
+        try:
+            downloader.download(server.url + '/redirect' * 10 + '/files/1', 
+                                path)
+            assert False, 'expected an error'
+        except HTTPError, e:
+            assert 'too many redirects' in str(e)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+
+def test_download_media():
+    server = start_server(FilesHandler)
+    folder = tempfile.mkdtemp()
+    try:
+        api = API(host=server.url)
+        posts = []
+        for id in (1, 2):
+            post = Post(api)
+            post.id = id
+            post.media = []
+            for size in (100, 2000):
+                media = Media(api)
+                media.url = '%s/files/%d.jpg' % (server.url, size * id)
+                post.media.append(media)
+            posts.append(post)
+        posts[1].media[1].url = server.url + '/missing/0'
+
+        results = api.download_media(posts, folder)
+        assert [os.path.basename(p) for m, p, e in results] == \
+               ['1-100.jpg', '1-2000.jpg', '2-200.jpg', '2-0']
+        assert [e is None for m, p, e in results] == [True, True, True, False]
+        assert open(results[1][1], 'rb').read() == file_data(2000)
+
+        path = posts[0].media[0].download(folder)
+        assert path == os.path.join(folder, '100.jpg')
+        assert open(path, 'rb').read() == file_data(100)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+
+def test_multipart_upload():
+    server = start_server(PostsHandler)
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'video.mov')
+        with open(path, 'wb') as f:
+            f.write(file_data(300000))
+        photo = open(get_file_name('sites.xml'), 'rb')
+        progress = []
+
+        api = API('user', 'pass', host=server.url)
+        post = api.new_post(site_id=1, title=u'Caf\xe9', 
+                            media=[File(path), photo, 'raw data', 
+                                   io.open(path, 'rb'),
+                                   StringIO.StringIO('buffered')],
+                            progress=lambda sent, total: 
+                                progress.append((sent, total)))
+        assert post.id == 24
+
+        content_type, data = server.posted[-1]
+        type, params = cgi.parse_header(content_type)
+        assert type == 'multipart/form-data'
+        fields = cgi.parse_multipart(StringIO.StringIO(data), params)
+        assert fields['site_id'] == ['1'] and fields['title'] == ['Caf\xc3\xa9']
+        photo.seek(0)
+        assert fields['media[]'] == [file_data(300000), photo.read(), 
+                                     'raw data', file_data(300000), 
+                                     'buffered']
+        assert 'filename="video.mov"' in data
+        assert 'filename="sites.xml"' in data
+
+        # sent in chunks, not all at once
+        assert len(progress) > 10
+        assert progress[-1] == (len(data), len(data))
+        assert [s for s, t in progress] == sorted(s for s, t in progress)
+
+        # a string is file data, even if it names a file
+        api.new_post(site_id=1, title='Data', media=path)
+        content_type, data = server.posted[-1]
+        fields = cgi.parse_multipart(StringIO.StringIO(data), 
+                                     cgi.parse_header(content_type)[1])
+        assert fields['media'] == [path]
+        spooled = tempfile.SpooledTemporaryFile()
+        spooled.write('spooled')
+        spooled.seek(0)
+        api.new_post(site_id=1, title='Spooled', media=spooled)
+        assert 'spooled' in server.posted[-1][1]
+
+        # requests without files are still form encoded
+        api.new_post(site_id=1, title='No media')
+        assert server.posted[-1][0] == 'application/x-www-form-urlencoded'
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+
+def test_post_importer():
+    server = start_server(PostsHandler)
+    folder = tempfile.mkdtemp()
+    try:
+        image = os.path.join(folder, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(file_data(1000))
+        posts = [{'key': 'a', 'title': 'A', 'media': [image]},
+                 {'key': 'b', 'title': 'FAIL'},
+                 {'title': 'C', 'date': '2010-05-03T19:58:58Z'},
+                 {'title': 'D', 'date': 'Sun, 03 May 2009 19:58:58 -0800'},
+                 {'title': 'E', 'tags': 'x,y'}]
+        checkpoint = os.path.join(folder, 'checkpoint')
+        api = API('user', 'pass', host=server.url)
+        reported = []
+
+        start = time.time()
+        importer = PostImporter(api, max_workers=3, rate=20, 
+                                checkpoint=checkpoint)
+        results = importer.run(iter(posts), 
+                               lambda *result: reported.append(result))
+        # 5 posts at 20 per second
+        assert time.time() - start >= 0.19
+        assert [key for key, post, error in results] == \
+               ['a', 'b', '2', '3', '4']
+        assert [post and post.id for key, post, error in results] == \
+               [24, None, 24, 24, 24]
+        assert isinstance(results[1][2], PosterousError)
+        assert sorted(key for key, post, error in reported) == \
+               sorted(key for key, post, error in results)
+        assert any(file_data(1000) in data for t, data in server.posted)
+        assert posts[0]['media'] == [image]
+
+        # a second run only retries the failed post
+        del server.requests[:]
+        results = importer.run(posts)
+        assert server.requests == ['/api/newpost']
+        assert [error is not None for key, post, error in results] == \
+               [False, True, False, False, False]
+        assert [post for key, post, error in results] == [None] * 5
+
+        # an item that isn't a post fails on its own
+        results = PostImporter(api).run([{'title': 'F'}, ['G']])
+        assert [post and post.id for key, post, error in results] == \
+               [24, None]
+        assert isinstance(results[1][2], PosterousError)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+
+IMPORT_SCRIPT = get_file_name(os.path.join('..', 'scripts', 
+                                         'import-posterous.py'))
+
+
+def test_import_script_skips_invalid_lines():
+    script = imp.load_source('import_posterous', IMPORT_SCRIPT)
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'posts.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"title": "A"}\n{"title": \n\n["B"]\n'
+                    '{"title": "C", "key": "c"}\n{"title": "D", "media": [5]}\n'
+                    '{"title": "E", "media": "e.jpg"}\n')
+        invalid = []
+        posts = list(script.read_posts(path, 1, invalid))
+        assert [(p['key'], p['title']) for p in posts] == [(1, 'A'), 
+                                                           ('c', 'C'),
+                                                           (7, 'E')]
+        assert posts[2]['media'] == [os.path.join(folder, 'e.jpg')]
+        assert [key for key, post, error in invalid] == ['2', '4', '6']
+        assert all(isinstance(error, ValueError) and
+                   str(error).startswith('Line ')
+                   for key, post, error in invalid)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(20, capacity=2)
+    start = time.time()
+    for i in range(6):
+        bucket.acquire()
+    # a burst of 2, then 4 at 20 per second
+    assert 0.18 <= time.time() - start < 0.5
+
+    bucket.throttled(0.1)
+    assert bucket.rate == 10
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= 0.1
+    for i in range(30):
+        bucket.succeeded()
+    assert bucket.rate == 20
+
+    # buckets sharing a file share the tokens
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'bucket')
+        first = FileTokenBucket(path, 10, capacity=2)
+        second = FileTokenBucket(path, 10, capacity=2)
+        start = time.time()
+        first.acquire()
+        first.acquire()
+        second.acquire()
+        assert time.time() - start >= 0.09
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_throttled_requests():
+    server = start_server(ThrottlingHandler)
+    server.status, server.retry_after = 429, '0'
+    try:
+        # sent again while the server throttles
+        server.throttle = 2
+        api = API(host=server.url, rate_limit=100)
+        assert len(api.read_posts(site_id=1)) == 10
+        assert len(server.requests) == 3
+        # halved twice, then raised by the successful request
+        assert api.limiter.rate == 30
+
+        server.throttle, server.status = 5, 503
+        try:
+            API(host=server.url, max_retries=1).read_posts(site_id=1)
+            assert False, 'expected a RateLimitError'
+        except RateLimitError, e:
+            assert e.error_code == 503 and e.retry_after == 0
+
+        server.throttle, server.status = 1, 500
+        try:
+            api.read_posts(site_id=1)
+            assert False, 'expected an HTTPError'
+        except HTTPError, e:
+            assert e.error_code == 500
+            assert not isinstance(e, RateLimitError)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    try:
+        API(host=server.url).read_posts(site_id=1)
+        assert False, 'expected a TransportError'
+    except TransportError:
+        pass
+
+
+def test_json_parser():
+    with open(get_file_name('posts.xml')) as f:
+        payload = f.read()
+    posts = ET.XML(payload)
+    json_payload = json.dumps([element_json(post) for post in posts])
+
+    class JSONMethod(PostsMethod):
+        response_type = 'json'
+
+    expected = model_state(ModelParser().parse(PostsMethod, payload))
+    for parser in (ModelParser(), DirectModelParser()):
+        assert model_state(parser.parse(JSONMethod, json_payload)) == expected
+    # servers without JSON answer in XML
+    assert model_state(ModelParser().parse(JSONMethod, payload)) == expected
+
+    server = start_server(PostsHandler)
+    try:
+        api = API('user', 'pass', host=server.url)
+        assert model_state(api.read_posts(site_id=1, response_type='json')) \
+               == model_state(api.read_posts(site_id=1))
+        assert len(api.get_sites(response_type='json')) == 2
+        assert api.twitter_upload(username='u', password='p', 
+                                  media='data') == \
+               {'id': 24, 'url': 'http://post.ly/24'}
+    finally:
+        server.shutdown()
+
+
+def test_bound_parameters():
+    api = API('user', 'pass', host='http://example.com')
+    read_posts = api.read_posts.api_method
+    method = read_posts(api, (1, None, 5), {'tag': 'x', 'page': 2, 
+                                            'unknown': 1})
+    assert method.parameters == [('site_id', '1'), ('num_posts', '5'),
+                                 ('page', '2'), ('tag', 'x')]
+    # a falsy positional arg may be given as keyword instead
+    method = read_posts(api, (1, ''), {'hostname': 'h'})
+    assert method.parameters == [('site_id', '1'), ('hostname', 'h')]
+    try:
+        read_posts(api, (1,), {'site_id': 2})
+        assert False
+    except TypeError:
+        pass
+
+    # the caller's headers are left alone
+    headers = {'X-Test': '1'}
+    method = read_posts(api, (), {'headers': headers, 
+                                  'response_type': 'json'})
+    assert method.headers['Accept'] == 'application/json'
+    assert headers == {'X-Test': '1'}
+
+    assert api.api_url == 'http://example.com/api'
+    assert api.auth_header == 'Basic dXNlcjpwYXNz'
+    api.password = None
+    assert api.auth_header is None
+    api.api_root = '/v2'
+    assert api.api_url == 'http://example.com/v2'
+    try:
+        api.new_post(site_id=1, title='t')
+        assert False
+    except PosterousError, e:
+        assert 'Authentication' in str(e)
+
+
+def test_transports():
+    server = MockServer(num_sites=3, num_posts=25, num_comments=1).start()
+    recording = tempfile.mktemp()
+    try:
+        api = API('user', 'pass', host=server.url,
+                  transport=RecordingTransport(UrllibTransport(), recording))
+        sites = api.get_sites()
+        assert [s.id for s in sites] == [1, 2, 3]
+        posts = api.read_posts(site_id=1, num_posts=10, page=3)
+        assert [p.id for p in posts] == range(21, 26)
+        assert len(posts[0].comments) == 1
+        try:
+            api.get_post('999')
+            assert False
+        except PosterousError, e:
+            assert e.error_code == '3001'
+        assert server.requests['/api/readposts'] == 1
+
+        pooled = API('user', 'pass', host=server.url)
+        assert model_state(pooled.read_posts(site_id=1, num_posts=10, 
+                                             page=3)) == model_state(posts)
+        try:
+            pooled.new_post(site_id=1, title='t')
+            assert False
+        except HTTPError, e:
+            assert e.error_code == 404
+    finally:
+        server.stop()
+
+    # answered without the server, from a recording in JSON
+    try:
+        with open(recording) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['url'].split('?')[0] for r in records][:2] == \
+               [server.url + '/api/getsites', server.url + '/api/readposts']
+        assert 'Site number 1' in base64.b64decode(records[0]['payload'])
+        api = API('user', 'pass', host=server.url,
+                  transport=ReplayTransport(recording))
+        assert model_state(api.get_sites()) == model_state(sites)
+        assert model_state(api.read_posts(site_id=1, num_posts=10, 
+                                          page=3)) == model_state(posts)
+        try:
+            api.read_posts(site_id=2)
+            assert False
+        except PosterousError, e:
+            assert 'No response recorded' in str(e)
+    finally:
+        os.remove(recording)
+
+
+def test_metrics():
+    server = MockServer(num_posts=25).start()
+    statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsd.bind(('127.0.0.1', 0))
+    statsd.settimeout(5)
+    try:
+        metrics = MetricsCollector()
+        api = API('user', 'pass', host=server.url, metrics=metrics)
+        for parser in (ModelParser(), DirectModelParser()):
+            api.parser = parser
+            assert len(api.read_posts(site_id=1)) == 10
+        assert len(list(api.read_posts(site_id=1, page=3, stream=True))) == 5
+        try:
+            api.get_post('999')
+            assert False
+        except PosterousError:
+            pass
+
+        stats = metrics.snapshot()
+        assert stats['readposts']['requests'] == 3
+        assert stats['readposts']['received'] > 0
+        assert sorted(stats['readposts']['seconds']) == \
+               ['build', 'connect', 'download', 'parse', 'ttfb']
+        assert stats['getpost']['requests'] == 0
+        assert stats['getpost']['errors'] == {'PosterousError': 1}
+        text = metrics.prometheus()
+        assert 'posterous_requests_total{method="readposts"} 3\n' in text
+        assert 'posterous_request_seconds_total{method="readposts",' \
+               'phase="ttfb"}' in text
+        assert 'posterous_errors_total{method="getpost",' \
+               'error="PosterousError"} 1\n' in text
+
+        api.metrics = StatsdMetrics(*statsd.getsockname())
+        api.read_posts(site_id=1)
+        lines = statsd.recv(4096).split('\n')
+        assert 'posterous.readposts.requests:1|c' in lines
+        assert [l for l in lines if l.startswith('posterous.readposts.parse:')]
+
+        # nothing is measured by default
+        api = API('user', 'pass', host=server.url)
+        assert api.read_posts.api_method(api, (), {}).timings is None
+    finally:
+        statsd.close()
+        server.stop()
+
+
+BACKUP_SCRIPT = get_file_name(os.path.join('..', 'scripts', 
+                                         'backup-posterous.py'))
+
+
+def run_backup(server, folder, *args):
+    """Runs the backup script and returns its output"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([get_file_name('..')] + 
+                                        filter(None, [env.get('PYTHONPATH')]))
+    proc = subprocess.Popen([sys.executable, BACKUP_SCRIPT, '-u', 'user', 
+                             '-p', 'pass', '--host', server.url, 
+                             '-f', folder, '-b', '10', '-q'] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                            env=env)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+    return out
+
+
+def backed_up_posts(folder):
+    db = sqlite3.connect(os.path.join(folder, 'manifest.db'))
+    try:
+        return sorted(row[0] for row in db.execute('SELECT post_id FROM posts'))
+    finally:
+        db.close()
+
+
+class FailingPageServer(MockServer):
+    """Fails the readposts page 'fail_page'"""
+    fail_page = None
+
+    def readposts(self, params):
+        if params.get('page') == str(self.fail_page):
+            return ERROR % (500, 'Failed')
+        return MockServer.readposts(self, params)
+
+
+def test_backup_manifest():
+    backup = imp.load_source('backup_posterous', BACKUP_SCRIPT)
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'manifest.db')
+        manifest = backup.Manifest(path)
+        assert not manifest.is_complete(1)
+        manifest.set_complete(1, False)
+        manifest.add_post(1, 5, 'date', 'hash', 'file.json')
+        manifest.add_media('http://m/1.jpg', 'file_0.jpg', 10)
+        manifest.close()
+
+        manifest = backup.Manifest(path)
+        assert not manifest.is_complete(1)
+        assert manifest.post_hash(1, 5) == 'hash'
+        assert manifest.post_hash(2, 5) is None
+        assert manifest.media('http://m/1.jpg') == ('file_0.jpg', 10)
+        # kept even if the backup is killed before closing the manifest
+        manifest.set_complete(1, True)
+        assert backup.Manifest(path).is_complete(1)
+        manifest.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_backup_resumes_incomplete_sites():
+    server = FailingPageServer(num_sites=1, num_posts=35).start()
+    folder = tempfile.mkdtemp()
+    try:
+        # the last page fails, so the first run is incomplete
+        server.fail_page = 4
+        run_backup(server, folder)
+        assert backed_up_posts(folder) == range(1, 31)
+
+        # the first page is unchanged, but all pages are walked again
+        server.fail_page = None
+        server.requests.clear()
+        run_backup(server, folder)
+        assert server.requests['/api/readposts'] == 4
+        assert backed_up_posts(folder) == range(1, 36)
+
+        # complete now, so paging stops at the unchanged first page
+        server.requests.clear()
+        run_backup(server, folder)
+        assert server.requests['/api/readposts'] == 1
+        assert '/getfile' not in server.requests
+    finally:
+        server.stop()
+        shutil.rmtree(folder)
+
+
+def test_backup_pipeline():
+    backup = imp.load_source('backup_posterous', BACKUP_SCRIPT)
+    server = MockServer(num_sites=2, num_posts=35, num_media=2).start()
+    folder = tempfile.mkdtemp()
+    written, downloaded = [], []
+
+    def write_post(site, site_folder, p, hash):
+        written.append((site.id, p.id))
+        return backup.write_post(site, site_folder, p, hash)
+
+    def download_media(site, url, media_file):
+        downloaded.append((site.id, url))
+        return backup.download_media(site, url, media_file)
+
+    # the globals the script sets up when it's run
+    backup.options = Values({'batch_size': 10, 'full': False})
+    backup.api = API('user', 'pass', host=server.url)
+    backup.manifest = backup.Manifest(os.path.join(folder, 'manifest.db'))
+    backup.pages = backup.Stage('pages', backup.fetch_page, 4, maxsize=0)
+    backup.writer = backup.Stage('posts', write_post)
+    backup.media = backup.Stage('media', download_media, 4, maxsize=10)
+    stages = (backup.pages, backup.writer, backup.media)
+    try:
+        for stage in stages:
+            stage.start()
+        for site in backup.api.get_sites():
+            site_folder = os.path.join(folder, site.hostname)
+            os.makedirs(os.path.join(site_folder, 'private'))
+            for page in range(1, 5):
+                backup.pages.put(site, site_folder, page, False)
+
+        # a stalled pipeline fails the test instead of hanging it
+        thread = threading.Thread(target=lambda: [stage.join() 
+                                                  for stage in stages])
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive(), 'the pipeline stalled'
+        assert not any(t.is_alive() for stage in stages 
+                       for t in stage._threads)
+
+        assert [stage.failures for stage in stages] == [[], [], []]
+        posts = [(site_id, post_id) for site_id in (1, 2) 
+                 for post_id in range(1, 36)]
+        assert sorted(written) == posts
+        assert len(downloaded) == len(set(downloaded)) == 2 * 35 * 2
+        assert server.requests['/getfile'] == 2 * 35 * 2
+        for hostname in ('site1', 'site2'):
+            files = os.listdir(os.path.join(folder, hostname))
+            assert len([f for f in files if f.endswith('.json')]) == 35
+            assert len([f for f in files if f.endswith('.jpg')]) == 35 * 2
+    finally:
+        backup.manifest.close()
+        server.stop()
+        shutil.rmtree(folder)
+
+
+def test_xmldict_groups_siblings():
+    element = ET.XML('<post><id>1</id><tag>a</tag><tag>b</tag><body/>'
+                     '<Tag>c</Tag><media><url>u</url></media></post>')
+    data = XMLDict(element)
+    assert data['id'] == 1
+    assert data['tag'] == ['a', 'b', 'c']
+    assert data['body'] == ''
+    assert data['media'] == {'url': 'u'}
+
+
+def test_register_type():
+    assert set_type('id', '12') == 12
+    assert set_type('private', 'True') is True
+    assert set_type('title', '12') == '12'
+    # a substring of 'date' is not a date
+    assert set_type('at', 'x') == 'x'
+
+    register_type(('Title', 'name'), lambda v: v.upper())
+    try:
+        assert set_type('title', 'abc') == 'ABC'
+        assert XMLDict(ET.XML('<site><name>a</name></site>'))['name'] == 'A'
+    finally:
+        del casters['title'], casters['name']
+
+
+def test_parse_datetime():
+    assert parse_datetime('Sun, 03 May 2009 19:58:58 -0800') == \
+           datetime(2009, 5, 4, 3, 58, 58)
+    assert parse_datetime('Mon, 25 Jan 2010 00:00:20 +0130') == \
+           datetime(2010, 1, 24, 22, 30, 20)
+    for invalid in ('', 'Sun, 03 Foo 2009 19:58:58 -0800', 'yesterday'):
+        try:
+            parse_datetime(invalid)
+            assert False, invalid
+        except ValueError:
+            pass
+
+
+def test_empty_typed_elements():
+    payload = ('<rsp stat="ok"><post><id>1</id><views></views><date/>'
+               '<private> </private><commentscount/></post></rsp>')
+
+    class JSONMethod(PostsMethod):
+        response_type = 'json'
+
+    json_payload = json.dumps([{'id': '1', 'views': '', 'date': '',
+                                'private': '', 'commentscount': ''}])
+    for parser in (ModelParser(), DirectModelParser(), LazyModelParser(),
+                   ModelParser(lazy_types=('date',)),
+                   DirectModelParser(lazy_types=('date',))):
+        for method, data in ((PostsMethod, payload), 
+                             (JSONMethod, json_payload)):
+            post = parser.parse(method, data)[0]
+            # empty elements aren't cast
+            assert post.id == 1
+            assert (post.views, post.date, post.private, 
+                    post.commentscount) == ('', '', '', '')
+
+
+def test_unsupported_response_type():
+    class YAMLMethod(PostsMethod):
+        response_type = 'yaml'
+
+    for parser in (ModelParser(), DirectModelParser(), LazyModelParser()):
+        for parse in (parser.parse, 
+                      lambda m, p: list(parser.parse_stream(
+                          m, StringIO.StringIO(p)))):
+            try:
+                parse(YAMLMethod, 'posts: []')
+                assert False, 'expected an error'
+            except PosterousError, e:
+                assert 'yaml' in str(e)
+
+
+def test_lazy_dates():
+    with open(get_file_name('posts.xml')) as f:
+        payload = f.read()
+    for parser in (ModelParser(lazy_types=('date',)),
+                   DirectModelParser(lazy_types=('date',)),
+                   ModelParser(CompactModelFactory, lazy_types=('date',))):
+        post = parser.parse(PostsMethod, payload)[0]
+        assert post._lazy_date[1] == 'Sun, 03 May 2009 19:58:58 -0800'
+        assert post.date == datetime(2009, 5, 4, 3, 58, 58)
+        assert post.comments[0].date == datetime(2009, 6, 4, 9, 33, 43)
+        assert not hasattr(post, 'missing')